@@ -0,0 +1,597 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+import argparse
+import datetime
+import hashlib
+import importlib
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+
+
+version = '1.0b'
+
+#-------------------------------------#
+#              cdx-bench              #
+#-------------------------------------#
+#  https://github.com/av1d/cdx-tools  #
+#-------------------------------------#
+
+##  Times cdx-filter's search modes, cdx-query's response conversion and
+##  cdxpress' matching on synthetic CDX data, and saves throughput and
+##  peak memory as a JSON report. The data is generated from a seed, so
+##  two reports made with the same --rows and --seed can be compared
+##  across commits (--compare). Every benchmark runs in its own process
+##  and is timed from start to exit, interpreter start-up included.
+
+toolDir = os.path.dirname(os.path.abspath(__file__))  # str. where cdf.py & co. are
+
+reportVersion = 1  # int. bumped when the report layout changes
+
+
+
+def banner():
+    info1  = "+-----------------------------+"
+    info2  = "\n|  cdx-bench v" + version + "            |\n"
+    banner = info1 + info2 + info1
+    return banner
+
+
+
+def sep():
+    return "------------\n"
+
+
+
+def setArgs():
+    parser = argparse.ArgumentParser(
+        description=banner(),
+        usage=(
+                'use "python %(prog)s --help" for more information'
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        '--rows',
+        metavar='N',
+        type=int,
+        nargs='+',
+        default=[10000, 100000],
+        required=False,
+        help=
+                "Dataset sizes to run every benchmark on.\n" +
+                "Example: --rows 10000 1000000 50000000\n" +
+                "Default: 10000 100000.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        required=False,
+        help=
+                "Seed of the data generator. Default: 1.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--only',
+        metavar='NAME',
+        nargs='+',
+        required=False,
+        help=
+                "Only run these benchmarks (see --list).\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--list',
+        action='store_true',
+        required=False,
+        help=
+                "List the benchmarks and exit.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=3,
+        required=False,
+        help=
+                "Runs of every benchmark, the fastest one is reported.\n" +
+                "Default: 3.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--data-dir',
+        metavar='DIR',
+        required=False,
+        help=
+                "Where generated datasets are kept, so later runs with\n" +
+                "the same --rows and --seed reuse them.\n" +
+                "Default: ~/.cache/cdx-tools/bench\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--generate-only',
+        action='store_true',
+        required=False,
+        help=
+                "Generate the datasets and exit.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '-o',
+        '--report',
+        metavar='REPORT_FILE',
+        default='bench-report.json',
+        required=False,
+        help=
+                "JSON report file. Default: bench-report.json\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--compare',
+        metavar='OLD_REPORT',
+        required=False,
+        help=
+                "Print the change in throughput against an earlier\n" +
+                "report, e.g. one made on the previous commit.\n"
+                + sep(),
+    )
+
+    global args
+    args = vars(parser.parse_args())
+
+    if args['repeat'] < 1 or min(args['rows']) < 1:
+        print("Error: --rows and --repeat must be at least 1.\n")
+        sys.exit(1)
+    if args['only'] != None:
+        for name in args['only']:
+            if name not in benchmarks:
+                print("Error: unknown benchmark " + name + ", see --list.\n")
+                sys.exit(1)
+
+
+
+##  DATA GENERATOR
+##  Hosts are drawn from a Zipf distribution, a few sites hold most of the
+##  captures as in real CDX data. Paths mix extensions in web-like
+##  proportions, and later years have more captures. A URL captured again
+##  often keeps its digest, so there are realistic duplicates to collapse.
+
+genHostCount = 20000  # int. distinct sites, fewer for small datasets
+genZipf      = 1.1    # float. exponent of the host distribution
+genBatch     = 10000  # int. records drawn per batch
+
+genExtensions = (  # tuple. (extension, mimetype, weight)
+                    ('html', 'text/html',                 30),
+                    ('',     'text/html',                 15),
+                    ('php',  'text/html',                  8),
+                    ('asp',  'text/html',                  2),
+                    ('jpg',  'image/jpeg',                10),
+                    ('png',  'image/png',                  6),
+                    ('gif',  'image/gif',                  4),
+                    ('css',  'text/css',                   4),
+                    ('js',   'application/javascript',     5),
+                    ('txt',  'text/plain',                 2),
+                    ('pdf',  'application/pdf',            2),
+                    ('xml',  'text/xml',                   2),
+                    ('zip',  'application/zip',            1),
+                    ('exe',  'application/x-msdownload',   1),
+                    ('mp3',  'audio/mpeg',                 1),
+)
+genStatus     = (('200', 80), ('301', 5), ('302', 5), ('404', 8), ('-', 2))
+genSubdomains = ('', 'www.', 'www.', 'cdn.', 'img.', 'blog.', 'forum.', 'ftp.')
+genTLDs       = ('com', 'com', 'com', 'org', 'net', 'de', 'co.uk', 'info')
+genWords      = (
+                    'index', 'home', 'news', 'about', 'images', 'files', 'download',
+                    'cgi-bin', 'archive', 'blog', 'forum', 'docs', 'media', 'static',
+                    'products', 'support', 'search', 'users', 'view', 'data'
+)
+genFields     = (
+                    'urlkey', 'timestamp', 'original', 'mimetype',
+                    'statuscode', 'digest', 'length'
+)
+
+
+
+def cumulative(weights):
+    total  = 0
+    result = []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+
+
+def surt(host, path):
+    # urlkey of a URL: host labels reversed without www, then the path.
+    labels = host.split(".")
+    if labels[0] == "www":
+        labels = labels[1:]
+    return ",".join(reversed(labels)) + ")" + path.lower()
+
+
+
+def generateRecords(rows, seed):
+
+    # Generator: rows CDX records as lists of genFields values.
+
+    rng       = random.Random(seed)
+    hostCount = max(10, min(genHostCount, rows // 20))
+    hostDraw  = cumulative([1 / (n + 1) ** genZipf for n in range(hostCount)])
+    extDraw   = cumulative([weight for ext, mime, weight in genExtensions])
+    statDraw  = cumulative([weight for status, weight in genStatus])
+    hosts     = [
+                    rng.choice(genSubdomains) + "site" + str(n) + "." + rng.choice(genTLDs)
+                    for n in range(hostCount)
+    ]
+
+    made = 0
+    while made < rows:
+        count = min(genBatch, rows - made)
+        for host, ext, status in zip(
+                rng.choices(hosts, cum_weights=hostDraw, k=count),
+                rng.choices(genExtensions, cum_weights=extDraw, k=count),
+                rng.choices(genStatus, cum_weights=statDraw, k=count)
+        ):
+            path = "/" + "/".join(rng.choice(genWords) for n in range(rng.randrange(3)))
+            if ext[0] != "":
+                path = path.rstrip("/") + "/" + rng.choice(genWords) + str(rng.randrange(50)) + "." + ext[0]
+            if rng.random() < 0.1:
+                path += "?id=" + str(rng.randrange(1000))
+            year      = 1996 + int(29 * rng.random() ** 0.6)  # more captures in later years
+            timestamp = (
+                            str(year) +
+                            "%02d%02d%02d%02d%02d" % (
+                                rng.randrange(1, 13), rng.randrange(1, 29),
+                                rng.randrange(24), rng.randrange(60), rng.randrange(60)
+                            )
+            )
+            original  = "http://" + host + path
+            revision  = rng.randrange(4)  # same URL and revision share a digest
+            digest    = hashlib.sha1((original + str(revision)).encode()).hexdigest()[:32].upper()
+            yield [
+                    surt(host, path), timestamp, original, ext[1],
+                    status[0], digest, str(rng.randrange(200, 500000))
+            ]
+        made += count
+
+
+
+def dataDir():
+    if args['data_dir'] != None:
+        return Path(args['data_dir']).resolve()  # the benchmarks run in temp dirs
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / ".cache")) / "cdx-tools" / "bench"
+
+
+
+def dataset(rows):
+
+    # Paths of the generated files for rows, made on first use:
+    #   records - JSON records, one per line, as saved by cdx-query
+    #   json    - raw JSON response of the CDX server
+    #   text    - raw text (output=text) response of the CDX server
+
+    directory = dataDir()
+    base  = directory / ("cdx-" + str(rows) + "-" + str(args['seed']))
+    files = {
+                'records': str(base) + ".json",
+                'json':    str(base) + ".response.json",
+                'text':    str(base) + ".response.txt",
+    }
+    if all(os.path.exists(name) for name in files.values()):
+        return files
+
+    directory.mkdir(parents=True, exist_ok=True)
+    print("Generating " + str(rows) + " rows in " + str(directory) + " ...")
+    partial = {kind: name + ".part" for kind, name in files.items()}
+    records  = open(partial['records'], 'w', encoding='utf-8')
+    response = open(partial['json'], 'w', encoding='utf-8')
+    text     = open(partial['text'], 'w', encoding='utf-8')
+    with records, response, text:
+        records.write("[\n")
+        response.write("[" + json.dumps(list(genFields)))
+        first = True
+        for row in generateRecords(rows, args['seed']):
+            records.write(("" if first == True else ",\n") + json.dumps(dict(zip(genFields, row))))
+            response.write(",\n" + json.dumps(row))
+            text.write(" ".join(row) + "\n")
+            first = False
+        records.write("\n]")
+        response.write("]\n")
+    for kind in files:
+        os.replace(partial[kind], files[kind])  # complete files only
+    return files
+
+
+
+##  BENCHMARKS
+##  cdf benchmarks run cdf.py itself on the records file. The cdq and
+##  cdxpress ones import the tool in a child process (--child) and run
+##  its parsing and matching functions on a saved response, so no network
+##  is involved.
+
+cdfScanStrings = ".exe,.zip,cgi-bin,download"
+cdfTextStrings = [".pdf", ".mp3", "/forum/", "search", "site1."]
+cdfJSONSearch  = [{'archives': ".zip,.exe", 'documents': ".pdf,.txt", 'scripts': "cgi-bin,.php"}]
+
+benchmarks = {  # dict. name -> (tool, input file, cdf arguments)
+                'cdf-scan':      ('cdf', 'records', ['-s', cdfScanStrings]),
+                'cdf-exclude':   ('cdf', 'records', ['-s', cdfScanStrings, '-x', "site1.,www."]),
+                'cdf-textfile':  ('cdf', 'records', ['-t', '{textfile}']),
+                'cdf-json':      ('cdf', 'records', ['-j', '{jsonfile}']),
+                'cdf-field':     ('cdf', 'records', ['-f', 'mimetype', 'application/pdf']),
+                'cdf-regex':     ('cdf', 'records', ['-r', 'original:.*\\.(exe|zip)', '!statuscode:404']),
+                'cdf-time':      ('cdf', 'records', ['--from', '2005', '--to', '2010']),
+                'cdf-collapse':  ('cdf', 'records', ['--collapse', 'urlkey', '--collapse-mode', 'global']),
+                'cdf-dedup':     ('cdf', 'records', ['--dedup-digest']),
+                'cdf-enumerate': ('cdf', 'records', ['-e', '{outdir}/hosts.txt']),
+                'cdf-index':     ('cdf', 'indexed', ['-s', cdfScanStrings]),
+                'cdq-json':      ('cdq', 'json', []),
+                'cdq-text':      ('cdq', 'text', []),
+                'cdxpress-json': ('cdxpress', 'json', []),
+                'cdxpress-text': ('cdxpress', 'text', []),
+}
+
+
+
+def indexDataset(files):
+
+    # A copy of the records file with a cdf --build-index index, kept apart
+    # so the other cdf benchmarks don't pick the index up. The scan has to
+    # be answered by the FTS trigram table, which --stats json shows.
+
+    name = files['records'][:-len(".json")] + ".indexed.json"
+    cdf  = [sys.executable, os.path.join(toolDir, 'cdf.py'), '-i', name]
+    if os.path.exists(name + ".sqlite") == False:
+        shutil.copyfile(files['records'], name)
+        subprocess.run(cdf + ['--build-index'], stdout=subprocess.DEVNULL, check=True)
+
+    result = subprocess.run(
+                cdf + ['-q', '-s', cdfScanStrings, '--stats', 'json'],
+                stdin=subprocess.DEVNULL, capture_output=True, check=True
+    )
+    queries = json.loads(result.stderr)['counters'].get('index_queries')
+    if queries != {'fts': 1}:
+        print(
+                "Error: the indexed scan of " + name + " didn't use the FTS index " +
+                "(" + str(queries) + "). Does this SQLite support the FTS5 trigram tokenizer?"
+        )
+        sys.exit(1)
+
+    files['indexed'] = name
+
+
+
+def childCDQ(inputFile, textFormat):
+
+    # cdx-query's conversion of a saved response: every row to a record
+    # dictionary, written as the JSON array it saves.
+
+    cdq = importlib.import_module('cdq')
+    cdq.cdxKeys = list(genFields) if textFormat == True else None
+    with open(os.devnull, 'w') as out:
+        cdq.writeRecords(out, cdq.cdxToDict(inputFile), 0)
+
+
+
+def childCDXPress(inputFile, textFormat):
+
+    # cdxpress' parsing and matching of a response as it streams in. The
+    # matched Wayback links are printed like in a real run.
+
+    cdxpress = importlib.import_module('cdxpress')
+    cdxpress.args = {'case_sensitive': False, 'outfile': None}
+    cdxpress.options   = {'scan': cdfScanStrings.split(',')}
+    cdxpress.neg_words = []
+    cdxpress.scanLINES = 0
+    cdxpress.compileMatcher()
+
+    chunks = cdxpress.fileChunks(open(inputFile, 'rb'))
+    if textFormat == True:
+        records = cdxpress.cdxTextRecords(chunks, list(genFields))
+    else:
+        records = cdxpress.cdxRecords(chunks)
+    for record in records:
+        cdxpress.checkMatch(record['original'], record['timestamp'])
+
+
+
+def runChild():
+
+    # python bench.py --child NAME INPUT_FILE, started by runOnce().
+
+    name, inputFile = sys.argv[2], sys.argv[3]
+    sys.path.insert(0, toolDir)
+    sys.argv = [name]  # the tools look at sys.argv when imported
+    tool, kind, extra = benchmarks[name]
+    if tool == 'cdq':
+        childCDQ(inputFile, kind == 'text')
+    else:
+        childCDXPress(inputFile, kind == 'text')
+
+
+
+def command(name, files, outdir):
+
+    # Command line of one run of benchmark name.
+
+    tool, kind, extra = benchmarks[name]
+    if tool != 'cdf':
+        return [sys.executable, os.path.abspath(__file__), '--child', name, files[kind]]
+
+    values = {
+                'outdir':   outdir,
+                'textfile': os.path.join(outdir, "strings.txt"),
+                'jsonfile': os.path.join(outdir, "search.json"),
+    }
+    with open(values['textfile'], 'w') as f:
+        f.write("\n".join(cdfTextStrings) + "\n")
+    with open(values['jsonfile'], 'w') as f:
+        json.dump(cdfJSONSearch, f)
+    return (
+            [sys.executable, os.path.join(toolDir, 'cdf.py'), '-i', files[kind], '-q'] +
+            [argument.format(**values) for argument in extra]
+    )
+
+
+
+def runOnce(name, files):
+
+    # Seconds and peak RSS in bytes of one run. wait4() gives the resource
+    # usage of that child alone.
+
+    outdir = tempfile.mkdtemp(prefix="cdx-bench-")
+    try:
+        cmd   = command(name, files, outdir)
+        start = time.perf_counter()
+        child = subprocess.Popen(
+                    cmd, cwd=outdir, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        errors = child.stderr.read()
+        pid, status, usage = os.wait4(child.pid, 0)
+        seconds = time.perf_counter() - start
+        child.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+    if child.returncode != 0:
+        print("Error: " + name + " failed:\n" + " ".join(cmd) + "\n" + errors.decode(errors='replace'))
+        sys.exit(1)
+
+    rss = usage.ru_maxrss
+    if sys.platform != 'darwin':  # kilobytes everywhere else
+        rss *= 1024
+    return seconds, rss
+
+
+
+def runBenchmark(name, rows, files):
+    tool, kind, extra = benchmarks[name]
+    size = os.path.getsize(files[kind])
+    runs = [runOnce(name, files) for n in range(args['repeat'])]
+    best = min(seconds for seconds, rss in runs)
+    return {
+            'name':        name,
+            'rows':        rows,
+            'input_bytes': size,
+            'seconds':     round(best, 4),
+            'runs':        [round(seconds, 4) for seconds, rss in runs],
+            'rows_per_sec': round(rows / best),
+            'mb_per_sec':  round(size / best / 1024 / 1024, 2),
+            'peak_rss_mb': round(max(rss for seconds, rss in runs) / 1024 / 1024, 1),
+    }
+
+
+
+##  REPORT
+
+def gitCommit():
+    try:
+        return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=toolDir,
+                capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def compareReports(old, new):
+
+    # Throughput of new against old for every benchmark both ran.
+
+    before = {(result['name'], result['rows']): result for result in old['results']}
+    print(
+            "\nCompared with " + str(args['compare']) +
+            " (commit " + str(old.get('commit')) + "):\n"
+    )
+    print("%-15s %10s %14s %14s %8s" % ("benchmark", "rows", "rows/s before", "rows/s now", "change"))
+    for result in new['results']:
+        key = (result['name'], result['rows'])
+        if key not in before:
+            continue
+        change = result['rows_per_sec'] / before[key]['rows_per_sec'] - 1
+        print(
+                "%-15s %10d %14d %14d %+7.1f%%" % (
+                    result['name'], result['rows'],
+                    before[key]['rows_per_sec'], result['rows_per_sec'], change * 100
+                )
+        )
+
+
+
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        runChild()
+        sys.exit(0)
+
+    setArgs()
+
+    if args['list'] == True:
+        for name in benchmarks:
+            print(name)
+        sys.exit(0)
+
+    names    = args['only'] if args['only'] != None else list(benchmarks)
+    datasets = {rows: dataset(rows) for rows in args['rows']}
+    if 'cdf-index' in names:
+        for rows in args['rows']:
+            indexDataset(datasets[rows])
+    if args['generate_only'] == True:
+        sys.exit(0)
+
+    old = None
+    if args['compare'] != None:
+        with open(args['compare'], 'r') as f:
+            old = json.load(f)
+
+    report = {
+                'report_version': reportVersion,
+                'commit':    gitCommit(),
+                'date':      datetime.datetime.now().isoformat(timespec='seconds'),
+                'python':    platform.python_version(),
+                'platform':  platform.platform(),
+                'cpus':      os.cpu_count(),
+                'seed':      args['seed'],
+                'repeat':    args['repeat'],
+                'results':   [],
+    }
+
+    print("%-15s %10s %9s %12s %9s %9s" % ("benchmark", "rows", "seconds", "rows/s", "MB/s", "RSS MB"))
+    for rows in args['rows']:
+        for name in names:
+            result = runBenchmark(name, rows, datasets[rows])
+            report['results'].append(result)
+            print(
+                    "%-15s %10d %9.3f %12d %9.2f %9.1f" % (
+                        name, rows, result['seconds'], result['rows_per_sec'],
+                        result['mb_per_sec'], result['peak_rss_mb']
+                    )
+            )
+
+    with open(args['report'], 'w') as f:
+        json.dump(report, f, indent=4)
+    print("\nReport saved to: " + str(args['report']))
+
+    if old != None:
+        compareReports(old, report)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -4,21 +4,45 @@
 import time
 startTime = time.time()
 import argparse
+import array
+import cdxcommon
+import collections
+import collections.abc
+import hashlib
+import heapq
 import ijson
+import io
 import json
+import math
+import mmap
+import multiprocessing
 import os
 import os.path
 import re
+import signal
+import sqlite3
+import struct
 import sys
+import tempfile
 import textwrap
+import threading
 import urllib.parse
 
+from cdxcommon import statsStart, statsEnable, statsEnter, statsCount
+from cdxcommon import statsIter, statsAsyncIter, printStats
+from cdxcommon import buildMatcher, findMatches
 from pathlib import Path
 from requests.utils import quote
 
 
 version = '1.2b'
 
+sinkBuffer = 1024 * 1024  # int. output buffer size in bytes for each sink
+statsOrder = (            # tuple. --stats phases in report order
+                    'import', 'setup', 'index', 'parse', 'filter', 'jobs',
+                    'match', 'enumerate', 'write', 'other'
+)
+
 #-------------------------------------#
 #         cdx-filter  by av1d         #
 #-------------------------------------#
@@ -56,10 +80,12 @@ def setArgs():
         '-i',
         '--infile',
         metavar='JSON_FILE',
+        nargs='+',
         required=True,
         help=
                 "Input file which contains valid JSON retrieved from \n" +
-                "the CDX server.\n"
+                "the CDX server, or a file saved by cdx-query --columnar.\n" +
+                "Several files are read one after the other.\n"
                 + sep(),
     )
     parser.add_argument(
@@ -115,9 +141,28 @@ def setArgs():
                 "Specifies which field in CDX file to search.\n" +
                 "Syntax:  --field [key] [string]\n" +
                 "Example: --field mimetype text/html\n" +
+                "The derived keys 'host' and 'ext' (URL file\n" +
+                "extension, lowercase, without the dot) are also accepted.\n" +
                 "Use with --outfile to save JSON result.\n"
                 + sep(),
     )
+    parser.add_argument(
+        '-r',
+        '--regex',
+        metavar='[!]field:regex',
+        nargs='+',
+        required=False,
+        help=
+                "Keep only records whose field matches the regex\n" +
+                "(the whole value, as on the CDX server). ! keeps the\n" +
+                "records that do NOT match. Several expressions can be\n" +
+                "given: a record is dropped if any ! expression matches,\n" +
+                "otherwise kept if any other expression matches.\n" +
+                "Same syntax as cdx-query --regex, quote each one.\n" +
+                "Works with the other searches, or alone to filter.\n" +
+                "Example: --regex 'original:.*\\.(exe|zip)' '!mimetype:image/.*'\n"
+                + sep(),
+    )
     parser.add_argument(
         '-x',
         '--exclude',
@@ -190,7 +235,169 @@ def setArgs():
         required=False,
         help=
                 "Subdomain enumeration.\n" +
-                "Create a list of all subhosts.\n"
+                "Create a list of all subhosts with the number of\n" +
+                "captures, first and last timestamps and total bytes.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--enum-format',
+        choices=['text', 'json'],
+        default='text',
+        required=False,
+        help=
+                "Output format for --enumerate.\n" +
+                "text - one host per line followed by its statistics:\n" +
+                "       host captures first_timestamp last_timestamp bytes\n" +
+                "json - JSON array with one dictionary per host.\n" +
+                "Default: text.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--from',
+        metavar='TIMESTAMP',
+        required=False,
+        help=
+                "Only records captured on or after this date.\n" +
+                "4 to 14 digits, yyyyMMddhhmmss. Example: --from 2005\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--to',
+        metavar='TIMESTAMP',
+        required=False,
+        help=
+                "Only records captured on or before this date.\n" +
+                "4 to 14 digits, yyyyMMddhhmmss. Example: --to 200806\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--collapse',
+        metavar='field[:N]',
+        nargs='+',
+        required=False,
+        help=
+                "Drop records whose field (or its first N characters)\n" +
+                "repeats, like the CDX server's collapse but locally, so\n" +
+                "a dump saved with --collapse none can be collapsed any\n" +
+                "way. Fields: urlkey, digest, timestamp, original or any\n" +
+                "other CDX field. Several fields are collapsed together.\n" +
+                "Works with the other searches, or alone to filter.\n" +
+                "Example: --collapse timestamp:8 urlkey (one per url/day)\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--collapse-mode',
+        choices=['adjacent', 'global'],
+        default='adjacent',
+        required=False,
+        help=
+                "adjacent - only collapse repeats next to each other,\n" +
+                "           as the CDX server does. No memory used.\n" +
+                "global   - collapse repeats anywhere in the input.\n" +
+                "Default: adjacent.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--collapse-memory',
+        metavar='MB',
+        type=int,
+        default=512,
+        required=False,
+        help=
+                "Memory for --collapse-mode global. When the seen keys\n" +
+                "outgrow it the rest are kept in a temporary file, so\n" +
+                "any input size works. Default: 512.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--dedup-digest',
+        action='store_true',
+        required=False,
+        help=
+                "Keep only the first capture of every digest + URL pair\n" +
+                "across all the --infile files, so overlapping pulls\n" +
+                "don't list the same payload twice. Uses a Bloom filter,\n" +
+                "see --dedup-expected and --dedup-exact.\n" +
+                "Works with the other searches, or alone to filter.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--dedup-expected',
+        metavar='N',
+        type=int,
+        default=10000000,
+        required=False,
+        help=
+                "Expected number of unique captures for --dedup-digest.\n" +
+                "Sizes the Bloom filter, about 1.2 MB per million, with\n" +
+                "1%% of new captures wrongly dropped at that count.\n" +
+                "Default: 10000000.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--dedup-exact',
+        action='store_true',
+        required=False,
+        help=
+                "Read the input twice so --dedup-digest never drops a\n" +
+                "new capture. Captures the Bloom filter flags are\n" +
+                "checked exactly on the second pass.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--dedup-memory',
+        metavar='MB',
+        type=int,
+        default=256,
+        required=False,
+        help=
+                "Memory for the flagged captures of --dedup-exact. The\n" +
+                "rest are kept in a temporary file. Default: 256.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--build-index',
+        action='store_true',
+        required=False,
+        help=
+                "Load --infile once into an indexed SQLite database\n" +
+                "(saved as INFILE.sqlite) then exit. Later scans of the\n" +
+                "same file use the index automatically.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        required=False,
+        help=
+                "Ignore INFILE.sqlite and read --infile directly.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        required=False,
+        help=
+                "Scan with N processes, 0 uses every CPU. The input is\n" +
+                "split into ranges matched in parallel, results are\n" +
+                "written in input order. JSON input needs one record per\n" +
+                "line (as saved by cdx-query and cdf). Default: 1.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=['text', 'json'],
+        required=False,
+        help=
+                "When done, print to stderr how long each phase took\n" +
+                "(import, setup, index, parse, filter, match, write)\n" +
+                "and counters: records, matches per search string,\n" +
+                "exclusions and bytes written per output.\n" +
+                "--stats json prints them as JSON.\n"
                 + sep(),
     )
     parser.add_argument(
@@ -206,6 +413,8 @@ def setArgs():
     global args  # dict
     args = vars(parser.parse_args())
 
+    statsEnable(args['stats'])  # print --stats when done
+
     ##  SYNTAX/INPUT/FILE CHECKING
 
     argCount = 0
@@ -231,11 +440,19 @@ def setArgs():
             args['textfile']  == None and
             args['json']      == None and
             args['field']     == None and
-            args['enumerate'] == None
+            args['enumerate'] == None and
+            args['regex']     == None and
+            args['from']      == None and
+            args['to']        == None and
+            args['collapse']  == None and
+            args['dedup_digest'] == False and
+            args['build_index'] == False
     ):
             print(
                     "Error: you must specify one of:\n" +
-                    "--scan, --textfile, --json, --field or --enumerate\n"
+                    "--scan, --textfile, --json, --field, --enumerate\n" +
+                    "or a filter: --regex, --from, --to, --collapse,\n" +
+                    "--dedup-digest\n"
             )
             sys.exit(1)
 
@@ -243,7 +460,7 @@ def setArgs():
             print("Error: you must specify an --infile when using --enumerate.\n")
             sys.exit(1)
 
-    if (args['make_list'] == args['infile']):
+    if (args['make_list'] in args['infile']):
         print(
                 "Error: You cannot use the same output name as the input file."
         )
@@ -303,12 +520,48 @@ def setArgs():
     global case_sensitive  # bool. case-sensitive or not
     global makeList        # bool. for plain text lists
     global makeHTML        # bool. for HTML generation
-    global infile          # str.  input CDX/JSON file
+    global infile          # str.  input CDX/JSON file (the first one)
+    global infiles         # list. every --infile
     global outfile         # str.  output file
     global listfile        # str.  plain text list file
     global htmlfile        # str.  html filename
     global enumfile        # str.  output file for subhost enumeration
     global jsonOutFile     # bool. if outputting JSON
+    global numJobs         # int.  processes for --jobs
+    global timeRange       # tuple. (first, last) 14 digit timestamps, None without --from/--to
+
+    if args['jobs'] < 0:
+        print("Error: --jobs must be 0 or more.\n")
+        sys.exit(1)
+    numJobs = args['jobs'] if args['jobs'] > 0 else os.cpu_count()
+
+    if args['collapse_memory'] < 1:
+        print("Error: --collapse-memory must be at least 1.\n")
+        sys.exit(1)
+
+    if args['dedup_expected'] < 1 or args['dedup_memory'] < 1:
+        print("Error: --dedup-expected and --dedup-memory must be at least 1.\n")
+        sys.exit(1)
+
+    if args['build_index'] == True and len(args['infile']) > 1:
+        print("Error: --build-index takes a single --infile.\n")
+        sys.exit(1)
+
+    for argument in ('from', 'to'):
+        if args[argument] != None:
+            if args[argument].isdigit() == False or not 4 <= len(args[argument]) <= 14:
+                print("Error: --" + argument + " must be 4-14 digits.\n")
+                sys.exit(1)
+    timeRange = None
+    if args['from'] != None or args['to'] != None:
+        # like the CDX server, a partial date covers its whole period
+        timeRange = (
+                        (args['from'] or "").ljust(14, "0"),
+                        (args['to'] or "").ljust(14, "9"),
+        )
+        if timeRange[1] < timeRange[0]:
+            print("Error: --to date is less than --from date.\n")
+            sys.exit(1)
 
     if args['enumerate'] != None:
         enumfile = args['enumerate']
@@ -325,7 +578,8 @@ def setArgs():
     else:
         case_sensitive = True
 
-    infile   = args['infile']
+    infiles  = args['infile']
+    infile   = infiles[0]
     outfile  = args['outfile']
     listfile = args['make_list']
     htmlfile = args['make_html']
@@ -343,11 +597,13 @@ def setArgs():
 
 def checkInputFile(argument):
 
-    if os.path.exists(args[argument]) == False:
-        print(
-                "Error: file " + str(args[argument]) + " doesn't exist."
-        )
-        sys.exit(1)
+    names = args[argument] if isinstance(args[argument], list) else [args[argument]]
+    for name in names:
+        if os.path.exists(name) == False:
+            print(
+                    "Error: file " + str(name) + " doesn't exist."
+            )
+            sys.exit(1)
 
 
 
@@ -375,6 +631,235 @@ def checkFileExistence(filename, filearg):
             return True
 
 
+def openSinks():
+
+    # Open every requested output target once. Writes go through a large
+    # buffer and are flushed when the sinks are closed or on a signal.
+
+    global sinks      # dict. open file objects keyed by target name
+    global jsonSinks  # dict. JSON array sinks, True until first record
+    sinks     = {}
+    jsonSinks = {}
+
+    if makeList == True:
+        sinks['list'] = open(listfile, 'a', buffering=sinkBuffer)
+    if makeHTML == True:
+        sinks['html'] = open(htmlfile, 'a', buffering=sinkBuffer)
+    if jsonOutFile != "":
+        openJSONSink('json', jsonOutFile)
+    if args['field'] != None and args['outfile'] != None:
+        openJSONSink('outfile', outfile)
+
+    signal.signal(signal.SIGINT, sinkSignal)
+    signal.signal(signal.SIGTERM, sinkSignal)
+
+
+
+def openJSONSink(name, filename):
+
+    # A JSON array written as it goes: '[' on open, one record per line
+    # with comma separators, ']' on close. If the run is killed the file
+    # is only missing its closing bracket, and loadCDX() can still read it.
+    # Appending to an existing array reopens it before its closing bracket.
+
+    first = True
+    start = b"[\n"
+
+    if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+        raw = open(filename, 'r+b')
+        head = raw.read(64).lstrip()
+        tailStart = max(0, os.path.getsize(filename) - 4096)
+        raw.seek(tailStart)
+        tail = raw.read().rstrip()
+        if tail[-1:] == b"]":  # complete array, drop the closing bracket
+            tail = tail[:-1].rstrip()
+        if head[:1] != b"[" or tail[-1:] not in (b"[", b"}"):
+            raw.close()
+            print("Error: " + str(filename) + " is not a JSON array, cannot append.")
+            sys.exit(1)
+        if tail[-1:] == b"}":  # array already holds records
+            first = False
+        raw.seek(tailStart + len(tail))
+        raw.truncate()
+        start = b""
+    else:
+        raw = open(filename, 'wb')
+
+    raw.write(start)
+    sinks[name] = io.TextIOWrapper(
+                                    io.BufferedWriter(raw, sinkBuffer),
+                                    encoding='utf-8'
+    )
+    jsonSinks[name] = first
+
+
+
+def writeSink(name, data):
+    sinks[name].write(data)
+    if cdxcommon.statsOn == True:
+        statsCount('output_bytes', len(data.encode('utf-8')), name)
+
+
+
+def writeJSONSink(name, record):
+    writeJSONText(name, json.dumps(record, default=dict))
+
+
+
+def writeJSONText(name, text):
+    if jsonSinks[name] == True:
+        jsonSinks[name] = False
+        writeSink(name, text)
+    else:
+        writeSink(name, ",\n" + text)
+
+
+
+def closeSink(name):
+    if name in jsonSinks:
+        writeSink(name, "\n]")  # terminate the array
+        del jsonSinks[name]
+    if name in sinks:
+        sinks.pop(name).close()  # close() flushes the buffer
+
+
+
+def closeSinks():
+    for name in list(sinks.keys()):
+        closeSink(name)
+
+
+
+def sinkSignal(signum, frame):
+    closeSinks()
+    print("\nInterrupted. Output written so far has been saved.")
+    sys.exit(1)
+
+
+
+##  PROGRESS
+##  While a scan runs and stdout is a terminal, a daemon thread redraws
+##  one line on stderr a few times a second: records per second, matches
+##  so far and how much of the input was read, from the byte offset of
+##  the open file (the row for columnar input). The scan itself only adds
+##  to the counters.
+
+progressOn       = False             # bool. a progress line is shown
+progressInterval = 0.25              # float. seconds between two redraws
+progressState    = {}                # dict. counters and position of the running scan
+progressLock     = threading.Lock()  # held while the line is drawn or cleared
+
+
+
+def progressStart():
+
+    global progressOn
+    if sys.stdout.isatty() == False:
+        return
+    progressState.update({
+                            'records':  0,
+                            'matches':  0,
+                            'sizes':    [os.path.getsize(name) for name in infiles],
+                            'file':     None,  # position in infiles of the file being read
+                            'position': None,  # callable, fraction of that file read
+                            'start':    time.time(),
+                            'stop':     threading.Event(),
+    })
+    progressOn = True
+    threading.Thread(target=progressLoop, args=(progressState['stop'],), daemon=True).start()
+
+
+
+def progressFile(name, position):
+    # Called when a file is opened, position() is the fraction read so far.
+    if progressOn == True:
+        progressState['file']     = infiles.index(name)
+        progressState['position'] = position
+        progressState['read']     = 0  # rows or ranges read, see progressRows()
+
+
+
+def progressIter(data):
+    if progressOn == False:
+        return data
+    return progressCounted(data)
+
+
+
+def progressCounted(data):
+    for line in data:
+        progressState['records'] += 1
+        yield line
+
+
+
+def progressRows(rows):
+    # Row numbers of a columnar file, the last one gives its position.
+    for row in rows:
+        progressState['read'] = row + 1
+        yield row
+
+
+
+def progressLine():
+
+    elapsed = max(time.time() - progressState['start'], 0.001)
+    line    = (
+                str(progressState['records']) + " records, "
+                + str(int(progressState['records'] / elapsed)) + " records/s, "
+                + str(progressState['matches']) + " matches"
+    )
+
+    if progressState['position'] != None:
+        sizes = progressState['sizes']
+        index = progressState['file']
+        read  = sum(sizes[:index]) + sizes[index] * min(progressState['position'](), 1.0)
+        line  = line + ", " + "%.1f" % (100.0 * read / max(sum(sizes), 1)) + "%"
+
+    return line
+
+
+
+def progressLoop(stop):
+    while stop.wait(progressInterval) == False:
+        try:
+            line = progressLine()
+        except (ValueError, OSError):  # the file was closed in between
+            continue
+        with progressLock:
+            if stop.is_set() == False:
+                sys.stderr.write("\r" + line + "\033[K")
+                sys.stderr.flush()
+
+
+
+def progressStop():
+    global progressOn
+    if progressOn == False:
+        return
+    progressOn = False
+    with progressLock:
+        progressState['stop'].set()
+        sys.stderr.write("\r\033[K")  # leave nothing behind
+        sys.stderr.flush()
+
+
+
+def progressPrint(text):
+
+    # print() for results shown during a scan, the progress line is cleared
+    # first and redrawn below them.
+
+    if progressOn == False:
+        print(text)
+        return
+    with progressLock:
+        sys.stderr.write("\r\033[K")
+        sys.stderr.flush()
+        print(text)
+
+
+
 def formatHTML():
     data = """        <!DOCTYPE html>
         <html lang="en">
@@ -407,8 +892,7 @@ def formatHTML():
         <ul>
     """
     data = textwrap.dedent(data)
-    with open(htmlfile, 'a') as f:
-        f.write(data + "\n")
+    writeSink('html', data + "\n")
 
 
 
@@ -423,8 +907,7 @@ def generateOutput(url_string, timestamp):
     )
 
     if makeList == True:
-        with open(listfile, 'a') as f:
-            f.write(outURL + "\n")
+        writeSink('list', outURL + "\n")
 
     if makeHTML == True:
         ht1 = '<li><a href="'
@@ -432,186 +915,1639 @@ def generateOutput(url_string, timestamp):
         ht3 = '" target="_blank">'
         ht4 = '</a></li>'
         outHTML = ht1 + ht2 + ht3 + ht2 + ht4
-        with open(htmlfile, 'a') as f:
-            f.write(outHTML + "\n")
+        writeSink('html', outHTML + "\n")
 
 
 
 def generateJSONList(data):
-    with open(jsonOutFile, 'a') as f:
-        f.write(json.dumps(data) + "\n")
+    previous = statsEnter('write')
+    writeJSONSink('json', data)
+    statsEnter(previous)
 
 
 
-def convertListToJSON():
+def compileMatcher():
 
-    jlist = []
-    with open(jsonOutFile) as f:
-        for line in f:
-            jlist.append(json.loads(line))
-    with open(jsonOutFile, 'w') as fp:
-        fp.write(
-                    '[\n' +
-                    ',\n'.join(json.dumps(i) for i in jlist) +
-                    '\n]'
-        )
+    # Build the automatons once from options and neg_words before scanning.
+
+    global matcher     # dict. automaton for search strings
+    global negMatcher  # dict. automaton for negative keywords
+    global matchKeys   # list. options key for each compiled pattern
+
+    matchKeys = []
+    patterns  = []
+    for key in options.keys():
+        for string in options[key]:
+            if case_sensitive == False:
+                string = string.lower()
+            matchKeys.append(key)
+            patterns.append(string)
+
+    matcher    = buildMatcher(patterns)
+    negMatcher = buildMatcher(neg_words)
+
+
+
+def matchedKeys(url_string):
+
+    # options key of every search string found in url_string, one entry
+    # per string. Empty if a negative keyword is found.
+
+    if case_sensitive == False:
+        url_string = url_string.lower()
+
+    if neg_words:  # if negative keywords were specified
+        excluded = findMatches(negMatcher, url_string, first=True)
+        if excluded:
+            if cdxcommon.statsOn == True:
+                statsCount('excluded', 1, negMatcher['patterns'][excluded[0]])
+            return []
+
+    if matcher['goto'] == None:  # same as findMatches(), without the call
+        found = [index for index, pattern in enumerate(matcher['patterns']) if pattern in url_string]
+    else:
+        found = findMatches(matcher, url_string)
+    if cdxcommon.statsOn == True:
+        for index in found:
+            if matcher['patterns'][index] != "":  # not the filters on their own
+                statsCount('matches', 1, matcher['patterns'][index])
+    return [matchKeys[index] for index in found]
 
 
 
 def checkMatch(url_string, timestamp):
+    for key in matchedKeys(url_string):
+        reportMatch(key, url_string, timestamp)
+
+
+
+def reportMatch(key, url_string, timestamp):
 
     global scanLINES  # int.  counter for --scan
     global textLINES  # int.  counter for --textfile
-    global neg_match  # bool. track if a negative keyword was found
+    global filterLINES # int. counter for the filters on their own
 
-    originalString = url_string
+    previous = statsEnter('write')
 
-    for key in options.keys():
-        currentKey = options[key]
-        for string in currentKey:
+    if progressOn == True:
+        progressState['matches'] += 1
 
-            if case_sensitive == False:
-                string        = string.lower()
-                url_string    = url_string.lower()
+    if args['quiet'] == False:
+        progressPrint(url_string)
+        if cdxcommon.statsOn == True:
+            statsCount('output_bytes', len(url_string.encode('utf-8')) + 1, 'stdout')
 
-            if neg_words:  # if negative keywords were specified
-                checkNegMatch(url_string)
+    if scanType == 'json':
+        jsonCounter[key] += 1
+    if scanType == 'scan':
+        scanLINES += 1
+    if scanType == 'field':
+        fieldLINES += 1
+    if scanType == 'textfile':
+        textLINES += 1
+    if scanType == 'filter':
+        filterLINES += 1
 
-            if neg_match == False:  # if no match on neg word, continue
-                if string in url_string:
-                    if args['quiet'] == False:
-                        print(originalString)
-    
-                    if scanType == 'json':
-                        jsonCounter[key] += 1
-                    if scanType == 'scan':
-                        scanLINES += 1
-                    if scanType == 'field':
-                        fieldLINES += 1
-                    if scanType == 'textfile':
-                        textLINES += 1
-    
-                    generateOutput(originalString, timestamp)
-    neg_match = False
+    generateOutput(url_string, timestamp)
+    statsEnter(previous)
 
 
 
-def checkNegMatch(url_string):  # check for negative keywords, if specified
-    global neg_match  # bool. track if a negative keyword was found
-    for word in neg_words:
-        if word in url_string:
-            neg_match = True
+##  REGEX FILTER
+##  cdf --regex takes [!]field:regex expressions, the syntax of cdx-query's
+##  --regex, and applies them locally. Like on the CDX server the regex
+##  must match the whole value. A record is dropped if any negative
+##  expression matches, otherwise it is kept if any positive one matches
+##  (or there are none). field is a CDX field name, 'host', 'ext' or the
+##  position of the field in the record.
 
 
 
-def loadCDX(infile):
+def compileRegex(expressions):
 
-    global dictKey  # str.  holds URL field name from CDX file.
+    # Compile every expression once. Negative and positive patterns on the
+    # same field are merged into one alternation, so each field is only
+    # searched once. Patterns with groups stay separate, merging would
+    # renumber their backreferences.
 
-    msg ="File isn't valid JSON or other error.\n"
+    flags   = 0 if case_sensitive == True else re.IGNORECASE
+    grouped = {'negative': {}, 'positive': {}}  # field -> list of patterns
 
+    for expression in expressions:
+        kind = 'positive'
+        if expression.startswith("!"):
+            kind       = 'negative'
+            expression = expression[1:]
+        field, colon, pattern = expression.partition(":")
+        if colon == "" or field == "":
+            print("Error: --regex must be [!]field:regex, got: " + expression + "\n")
+            sys.exit(1)
+        try:
+            re.compile(pattern, flags)
+        except re.error as e:
+            print("Error: invalid --regex pattern " + pattern + " (" + str(e) + ")\n")
+            sys.exit(1)
+        grouped[kind].setdefault(field, []).append(pattern)
+
+    filters = {'negative': [], 'positive': []}  # (field, compiled pattern)
+    for kind in filters:
+        for field, patterns in grouped[kind].items():
+            merge  = [p for p in patterns if re.compile(p, flags).groups == 0]
+            single = [p for p in patterns if re.compile(p, flags).groups != 0]
+            if len(merge) > 1:
+                try:
+                    alternation = "|".join("(?:" + p + ")" for p in merge)
+                    filters[kind].append((field, re.compile(alternation, flags)))
+                    merge = []
+                except re.error:  # e.g. inline flags, only allowed at the start
+                    pass
+            for pattern in merge + single:
+                filters[kind].append((field, re.compile(pattern, flags)))
+
+    return filters
+
+
+
+def regexValue(line, field):
+    if field.isdigit():  # position of the field
+        keys = list(line.keys())
+        return str(line[keys[int(field)]]) if int(field) < len(keys) else ""
     try:
-        with open(infile, 'r') as f:
-            data = json.load(f)
-    except:
-        print(msg)
-        sys.exit(1)
+        return fieldValue(line, field)
+    except KeyError:  # missing fields are empty
+        return ""
 
-    if 'file_url' in data[0].keys():
-        dictKey = 'file_url'
-    elif 'original' in data[0].keys():
-        dictKey = 'original'
-    else:
-        dictKey = None
-        print("Error: incompatible CDX format.\n" + msg)
-        sys.exit(1)
 
-    return data
 
+def regexMatch(line):
 
+    # True if the record passes --regex. Negatives are checked first so
+    # most rejected records cost a single search.
 
-def loadJSON(input_file):
+    for field, pattern in regexFilters['negative']:
+        if pattern.fullmatch(regexValue(line, field)) != None:
+            return False
 
-    global options  # dict
-    options = {}
+    if not regexFilters['positive']:
+        return True
+    for field, pattern in regexFilters['positive']:
+        if pattern.fullmatch(regexValue(line, field)) != None:
+            return True
+    return False
 
-    try:
-        with open(input_file, 'r') as f:
-            data = json.load(f)
-    except:
-        print("Error loading or parsing JSON file.\n")
-        sys.exit(1)
 
-    keys = data[0].keys()
 
-    for key in data[0]:
-        options[key] = data[0][key].split(',')
+def regexRecords(data):
+    # The records of data that pass --regex.
+    if regexFilters == None:
+        return data
+    return statsIter('filter', (line for line in data if regexMatch(line)))
 
 
 
+##  TIME RANGE
+##  --from/--to are padded to 14 digits like on the CDX server, so a
+##  partial date covers its whole period. Timestamps compare as strings.
 
-def main():
 
-    try:
-        if sys.argv[1] == "-v" or sys.argv[1] == "--version":
-            print("cdx-filter v" + version)
-            sys.exit(0)
-    except:
-        print("Expected at least 1 argument. --help for help.")
-        sys.exit(1)
 
+def timeMatch(line):
+    timestamp = str(line.get('timestamp', ''))[:14]
+    return timeRange[0] <= timestamp <= timeRange[1]
 
-    setArgs()
 
-    global infile    #str. input file
-    global outfile   #str. output file
 
-    data = loadCDX(infile)
+def timeSQL():
 
-    global options
-    options = {}
-    global options_count
-    options_count = {}
-    global scanLINES  #int.  counts found items
-    scanLINES = 0
-    global textLINES  #int.  counts found items
-    textLINES = 0
-    global scanType   #str.  tracks which type of search is being performed
-    scanType = None
-    global neg_words  #list. contains negative search words
-    neg_words = []
-    global neg_match  #bool. track if a negative keyword was found
-    neg_match = False
+    # WHERE condition and its parameters for --from/--to on the index.
+    # The timestamp index is NOCASE so the range is a binary search on it.
 
-    if args['make_html'] != None:
-        formatHTML()
+    if timeRange == None:
+        return "1", ()
+    return "timestamp COLLATE NOCASE BETWEEN ? AND ?", timeRange
 
 
-    ##  --exclude negative keywords.  build list of negative search keywords
-    if args['exclude'] != None:
-        neg_words = args['exclude'].split(',')  # split input string into list
 
-    ##  --textfile search
-    if args['textfile'] != None:
-        scanType = 'textfile'
-        textInputFile = args['textfile']
-        with open(textInputFile, 'r') as tfile:
-            allstrings = tfile.read()  # read is probably fine for this
-            parseLines = allstrings.split('\n')  # remove empty/space/newline
-            textStrings = [line for line in parseLines if line.strip()]
-            options['textfile'] = textStrings  # copy list to options dict
-        count = 0
-        for line in data:  # for each line in the CDX file
-            fileURL       = data[count][dictKey]  # assign keys
-            fileTimestamp = data[count]['timestamp']
-            checkMatch(fileURL, fileTimestamp)  # scan
-            if jsonOutFile != "":  # if generating JSON
-                generateJSONList(line)  # write line to temp file
-            count += 1
-        if jsonOutFile != "":  # if generating JSON
-            convertListToJSON()  # write final JSON file
+##  COLLAPSE
+##  cdf --collapse field[:N] drops records whose key (the fields, cut to
+##  N characters) was already seen. adjacent mode only compares with the
+##  previous record, like the CDX server. global mode keeps a 16 byte
+##  hash of every key seen; past --collapse-memory the new hashes go to a
+##  temporary SQLite table instead, so memory stays bounded.
 
-    ##  --json search
+collapseHashBytes = 100  # int. approximate memory per hash kept in the set
+
+
+
+def compileCollapse(expressions):
+
+    # List of (field, length) for --collapse, length None for the whole value.
+
+    fields = []
+    for expression in expressions:
+        field, colon, length = expression.partition(":")
+        if field == "" or (colon != "" and length.isdigit() == False):
+            print("Error: --collapse must be field or field:N, got: " + expression + "\n")
+            sys.exit(1)
+        fields.append((field, int(length) if colon != "" else None))
+    return fields
+
+
+
+def collapseKey(line):
+    values = []
+    for field, length in collapseFields:
+        value = regexValue(line, field)  # missing fields are empty
+        values.append(value[:length] if length != None else value)
+    return "\x00".join(values)
+
+
+
+def collapseAdjacent(data):
+    previous = None
+    for line in data:
+        key = collapseKey(line)
+        if key != previous:
+            previous = key
+            yield line
+
+
+
+def keyHash(key):
+    # 16 byte hash of a key, short enough to keep millions of them.
+    return hashlib.blake2b(key.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+
+def seenOpen(megabytes):
+
+    # A set of key hashes bounded to about megabytes of memory. Past the
+    # limit new hashes are stored in a temporary SQLite table.
+
+    return {
+            'set':   set(),
+            'limit': max(1, megabytes * 1024 * 1024 // collapseHashBytes),
+            'spill': None,  # sqlite3 connection, once the set is full
+            'file':  None,
+    }
+
+
+
+def seenAdd(seen, digest):
+
+    # Add digest, True if it was not there before.
+
+    if digest in seen['set']:
+        return False
+    if len(seen['set']) < seen['limit']:
+        seen['set'].add(digest)
+        return True
+    if seen['spill'] == None:
+        handle, seen['file'] = tempfile.mkstemp(prefix="cdf-seen-", suffix=".sqlite")
+        os.close(handle)
+        seen['spill'] = sqlite3.connect(seen['file'])
+        seen['spill'].execute("PRAGMA journal_mode = OFF")
+        seen['spill'].execute("PRAGMA synchronous = OFF")
+        seen['spill'].execute("CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+    inserted = seen['spill'].execute("INSERT OR IGNORE INTO seen VALUES (?)", (digest,))
+    return inserted.rowcount == 1
+
+
+
+def seenHas(seen, digest):
+    if digest in seen['set']:
+        return True
+    if seen['spill'] == None:
+        return False
+    return seen['spill'].execute(
+            "SELECT 1 FROM seen WHERE digest = ?", (digest,)
+    ).fetchone() != None
+
+
+
+def seenClose(seen):
+    if seen['spill'] != None:
+        seen['spill'].close()
+        seen['spill'] = None
+    if seen['file'] != None:
+        os.remove(seen['file'])
+        seen['file'] = None
+
+
+
+def collapseGlobal(data):
+    # Keep the first record of every key.
+    seen = seenOpen(args['collapse_memory'])
+    try:
+        for line in data:
+            if seenAdd(seen, keyHash(collapseKey(line))) == True:
+                yield line
+    finally:
+        seenClose(seen)
+
+
+
+def collapseRecords(data):
+    # The records of data left after --collapse.
+    if collapseFields == None:
+        return data
+    if args['collapse_mode'] == 'global':
+        return statsIter('filter', collapseGlobal(data))
+    return statsIter('filter', collapseAdjacent(data))
+
+
+
+##  DIGEST DEDUP
+##  cdf --dedup-digest keeps the first capture of every digest + URL pair
+##  across all the --infile files. Pairs are remembered in a Bloom filter
+##  sized from --dedup-expected, which never forgets a pair but may take a
+##  new one for a duplicate (bloomErrorRate of the time when the estimate
+##  holds). --dedup-exact reads the input twice instead: the first pass
+##  only flags the pairs the filter reports twice, the second keeps the
+##  first capture of each flagged pair, so no new capture is lost.
+
+bloomErrorRate = 0.01  # float. false positive rate at --dedup-expected pairs
+
+
+
+def bloomOpen(expected):
+
+    # Bit array and number of hashes for the error rate at expected items.
+
+    size   = max(64, math.ceil(-expected * math.log(bloomErrorRate) / math.log(2) ** 2))
+    hashes = max(1, round(size / expected * math.log(2)))
+    return {'bits': bytearray(size // 8 + 1), 'size': size, 'hashes': hashes, 'items': 0}
+
+
+
+def bloomAdd(bloom, digest):
+
+    # Set the bits of digest (a keyHash()), True if any of them was unset,
+    # i.e. digest is certainly new. The bit positions are derived from the
+    # two halves of the hash (double hashing), so only one hash is needed.
+
+    bits  = bloom['bits']
+    size  = bloom['size']
+    first = int.from_bytes(digest[:8], 'little')
+    step  = int.from_bytes(digest[8:], 'little') | 1
+    new   = False
+    for n in range(bloom['hashes']):
+        position = (first + n * step) % size
+        mask     = 1 << (position & 7)
+        if bits[position >> 3] & mask == 0:
+            bits[position >> 3] |= mask
+            new = True
+    if new == True:
+        bloom['items'] += 1
+    return new
+
+
+
+def dedupHash(line):
+    # keyHash() of the digest + URL pair, None for records without a digest.
+    try:
+        digest = fieldValue(line, 'digest')
+    except KeyError:
+        return None
+    return keyHash(digest + "\x00" + str(line[dictKey]))
+
+
+
+def dedupFlagged():
+
+    # First pass of --dedup-exact: hashes of the pairs seen more than once
+    # (or falsely reported so by the Bloom filter).
+
+    bloom   = bloomOpen(args['dedup_expected'])
+    flagged = seenOpen(max(1, args['dedup_memory'] // 2))
+    for line in loadInputs(timeFilter=True):
+        digest = dedupHash(line)
+        if digest != None and bloomAdd(bloom, digest) == False:
+            seenAdd(flagged, digest)
+    dedupCheckSize(bloom)
+    return flagged
+
+
+
+def dedupCheckSize(bloom):
+    if bloom['items'] > args['dedup_expected']:
+        if args['dedup_exact'] == True:
+            effect = "to flag fewer captures for the exact pass.\n"
+        else:
+            effect = "so fewer new captures are dropped.\n"
+        progressPrint(
+                "Warning: more than --dedup-expected " + str(args['dedup_expected']) +
+                " unique captures, the Bloom filter is overfull. " +
+                "Raise --dedup-expected " + effect
+        )
+
+
+
+def dedupBloom(data):
+
+    # One pass, drops every capture the Bloom filter has seen.
+
+    global dedupLINES  # int. captures dropped as duplicates
+
+    bloom = bloomOpen(args['dedup_expected'])
+    for line in data:
+        digest = dedupHash(line)
+        if digest == None or bloomAdd(bloom, digest) == True:
+            yield line
+        else:
+            dedupLINES += 1
+    dedupCheckSize(bloom)
+
+
+
+def dedupExact(data):
+
+    # Second pass, drops the repeats of the flagged pairs only.
+
+    global dedupLINES  # int. captures dropped as duplicates
+
+    flagged = dedupFlagged()
+    kept    = seenOpen(max(1, args['dedup_memory'] // 2))
+    try:
+        for line in data:
+            digest = dedupHash(line)
+            if digest == None or seenHas(flagged, digest) == False:
+                yield line
+            elif seenAdd(kept, digest) == True:
+                yield line
+            else:
+                dedupLINES += 1
+    finally:
+        seenClose(flagged)
+        seenClose(kept)
+
+
+
+def dedupRecords(data):
+    # The records of data left after --dedup-digest.
+    if args['dedup_digest'] == False:
+        return data
+    if args['dedup_exact'] == True:
+        return statsIter('filter', dedupExact(data))
+    return statsIter('filter', dedupBloom(data))
+
+
+
+##  COLUMNAR INPUT
+##  Reads the binary columnar format written by cdx-query --columnar.
+##  The layout is documented in cdq.py. The file is mapped with mmap and
+##  every column is a memoryview into the mapping, so reading a column
+##  only touches that column's bytes.
+
+columnarMagic = b"CDXC"
+columnarBLOB  = 1
+columnarFIXED = 2
+columnarDICT  = 3
+columnarBlock = 4096  # int. rows per entry of timestamp_blocks, same in cdq.py
+
+
+
+def columnarArray(view, typecode):
+
+    # Zero-copy integer array over the mapping (the format is little-endian).
+
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    values = array.array(typecode, view)  # big-endian host, copy and swap
+    values.byteswap()
+    return values
+
+
+
+def openColumnar(infile):
+
+    global cdxStore  # dict. open columnar file, None for JSON input
+
+    with open(infile, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mapping)
+
+    magic, fileVersion, ncols, nrows, position = struct.unpack_from('<4sHHQQ', buf, 0)
+
+    columns = {}
+    fields  = []
+    for n in range(ncols):
+        nameLength = struct.unpack_from('<H', buf, position)[0]
+        name = str(buf[position + 2:position + 2 + nameLength], 'utf-8')
+        position += 2 + nameLength
+        kind, derived, param, start, size = struct.unpack_from('<BBIQQ', buf, position)
+        position += struct.calcsize('<BBIQQ')
+
+        column = {'kind': kind}
+        if kind == columnarBLOB:
+            column['ends'] = columnarArray(buf[start:start + 8 * (nrows + 1)], 'Q')
+            column['data'] = buf[start + 8 * (nrows + 1):start + size]
+        elif kind == columnarFIXED:
+            column['width'] = param
+            column['data']  = buf[start:start + size]
+        else:  # columnarDICT, the table is small so it is decoded once
+            ends  = columnarArray(buf[start:start + 8 * (param + 1)], 'Q')
+            table = buf[start + 8 * (param + 1):]
+            column['table'] = [
+                    str(table[ends[i]:ends[i + 1]], 'utf-8') for i in range(param)
+            ]
+            idStart = start + 8 * (param + 1) + ends[param]
+            idStart += -idStart % 8
+            column['ids'] = columnarArray(buf[idStart:idStart + 4 * nrows], 'I')
+
+        columns[name] = column
+        if derived == 0:
+            fields.append(name)
+
+    cdxStore = {
+                'rows':    nrows,
+                'fields':  fields,
+                'columns': columns,
+    }
+    return cdxStore
+
+
+
+def columnValue(column, row):
+
+    if column['kind'] == columnarBLOB:
+        ends = column['ends']
+        return str(column['data'][ends[row]:ends[row + 1]], 'utf-8')
+    if column['kind'] == columnarFIXED:
+        width = column['width']
+        return str(column['data'][row * width:(row + 1) * width], 'utf-8').rstrip(' ')
+    return column['table'][column['ids'][row]]
+
+
+
+def columnarRows(store, start=0, end=None):
+
+    # Row numbers from start to end of a columnar file within --from/--to.
+    # Only the fixed width timestamp column is read, out of range rows are
+    # never decoded. With the timestamp_blocks column written by cdx-query
+    # a block of columnarBlock rows whose smallest and largest timestamps
+    # are both out of range is skipped without reading it, and a block
+    # fully within the range is taken whole. Other blocks (and files
+    # without timestamp_blocks) are compared row by row.
+
+    if end == None:
+        end = store['rows']
+
+    column = store['columns'].get('timestamp')
+    if column == None or column['kind'] != columnarFIXED or column['width'] != 14:
+        for row in range(start, end):
+            if timeMatch(ColumnarRow(store, row)):
+                yield row
+        return
+
+    blocks = store['columns'].get('timestamp_blocks')
+    if blocks != None and (
+            blocks['width'] != 28 or
+            len(blocks['data']) != 28 * -(-store['rows'] // columnarBlock)
+    ):
+        blocks = None  # not written the way this version expects
+
+    first = timeRange[0].encode('ascii')
+    last  = timeRange[1].encode('ascii')
+    for blockStart in range(start - start % columnarBlock, end, columnarBlock):
+        rowStart = max(start, blockStart)
+        rowEnd   = min(end, blockStart + columnarBlock)
+        if blocks != None:
+            offset   = blockStart // columnarBlock * 28
+            smallest = bytes(blocks['data'][offset:offset + 14])
+            largest  = bytes(blocks['data'][offset + 14:offset + 28])
+            if largest < first or smallest > last:
+                continue
+            if first <= smallest and largest <= last:
+                yield from range(rowStart, rowEnd)
+                continue
+        blob = bytes(column['data'][rowStart * 14:rowEnd * 14])
+        for i in range(0, len(blob), 14):
+            if first <= blob[i:i + 14] <= last:
+                yield rowStart + i // 14
+
+
+
+class ColumnarRow(collections.abc.Mapping):
+
+    # One record of a columnar file. Columns are only decoded when a key
+    # is read, so a scan that needs 'original' never touches the others.
+
+    __slots__ = ('store', 'row')
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row   = row
+
+    def __getitem__(self, key):
+        if key not in self.store['fields']:
+            raise KeyError(key)
+        return columnValue(self.store['columns'][key], self.row)
+
+    def __iter__(self):
+        return iter(self.store['fields'])
+
+    def __len__(self):
+        return len(self.store['fields'])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+
+def urlField(keys):
+    # URL field name of a CDX file (wayback_machine_downloader uses file_url).
+    if 'file_url' in keys:
+        return 'file_url'
+    if 'original' in keys:
+        return 'original'
+    return None
+
+
+
+def loadCDX(infile, timeFilter=False):
+
+    # Generator: yields one CDX record at a time so memory stays flat
+    # no matter how large the input file is. With timeFilter only the
+    # records within --from/--to are yielded.
+
+    if timeFilter == True and timeRange == None:
+        timeFilter = False
+
+    global dictKey  # str.  holds URL field name from CDX file.
+
+    msg ="File isn't valid JSON or other error.\n"
+
+    with open(infile, 'rb') as f:
+        magic = f.read(len(columnarMagic))
+    if magic == columnarMagic:  # written by cdx-query --columnar
+        store   = openColumnar(infile)
+        dictKey = urlField(store['fields'])
+        if dictKey == None and store['rows'] > 0:
+            print("Error: incompatible CDX format.\n" + msg)
+            sys.exit(1)
+        rows = columnarRows(store) if timeFilter == True else range(store['rows'])
+        if progressOn == True:
+            total = max(store['rows'], 1)
+            progressFile(infile, lambda: progressState['read'] / total)
+            rows = progressRows(rows)
+        for row in rows:
+            yield ColumnarRow(store, row)
+        return
+
+    global cdxStore  # dict. open columnar file, None for JSON input
+    cdxStore = None
+
+    count = 0  # int. records read so far
+
+    try:
+        with open(infile, 'rb') as f:
+            size = max(os.path.getsize(infile), 1)
+            progressFile(infile, lambda: f.tell() / size)
+            records = ijson.items(f, 'item', use_float=True)
+            first = True
+            for record in records:
+                if first == True:  # detect URL field name from first record
+                    dictKey = urlField(record.keys())
+                    if dictKey == None:
+                        print("Error: incompatible CDX format.\n" + msg)
+                        sys.exit(1)
+                    first = False
+                count += 1
+                if timeFilter == True and timeMatch(record) == False:
+                    continue
+                yield record
+    except ijson.IncompleteJSONError:
+        if count == 0:
+            print(msg)
+            sys.exit(1)
+        # most likely output from an interrupted run, keep what was read
+        progressPrint(
+                "Warning: " + str(infile) + " ends early, " +
+                "using the " + str(count) + " complete records found.\n"
+        )
+    except (ijson.JSONError, AttributeError, OSError):
+        print(msg)
+        sys.exit(1)
+
+
+
+def loadInputs(timeFilter=False):
+    # Every --infile, one after the other.
+    for name in infiles:
+        yield from loadCDX(name, timeFilter)
+
+
+
+def enumerateHosts(data):
+
+    # One streaming pass over the CDX records. Returns a dict (insertion
+    # ordered, in order of first appearance) of per-host statistics.
+
+    hosts = {}  # dict. host -> statistics
+
+    for line in data:
+        if cdxStore != None and 'host' in cdxStore['columns']:
+            # columnar input already has every host interned
+            theHost = columnValue(cdxStore['columns']['host'], line.row)
+        else:
+            theHost = hostOf(line[dictKey])
+
+        timestamp = str(line.get('timestamp', ''))
+        length    = str(line.get('length', ''))
+        length    = int(length) if length.isdigit() else 0
+
+        stats = hosts.get(theHost)
+        if stats == None:
+            hosts[theHost] = {
+                    'host':     theHost,
+                    'captures': 1,
+                    'first':    timestamp,
+                    'last':     timestamp,
+                    'length':   length,
+            }
+        else:
+            stats['captures'] += 1
+            stats['length']   += length
+            if timestamp < stats['first']:
+                stats['first'] = timestamp
+            if timestamp > stats['last']:
+                stats['last'] = timestamp
+
+    return hosts
+
+
+
+##  SQLITE INDEX
+##  cdf --build-index loads a dump once into <infile>.sqlite. Later runs
+##  on the same (unchanged) dump read candidate rows from the index
+##  instead of parsing the whole file. Every candidate still goes through
+##  the normal matching code, so results are identical either way.
+
+indexColumns = ('timestamp', 'statuscode', 'mimetype', 'host', 'ext')
+
+
+
+def hostOf(url):
+
+    # Host of a URL. urlsplit() only runs once per distinct scheme://host
+    # prefix, which is a tiny number compared to the number of captures.
+
+    slash  = url.find('/', url.find('//') + 2)
+    prefix = url if slash == -1 else url[:slash]
+    theHost = hostCache.get(prefix)
+    if theHost == None:
+        theHost = urllib.parse.urlsplit(prefix).netloc
+        hostCache[prefix] = theHost
+    return theHost
+
+
+
+def urlExtension(url):
+
+    # Lowercase file extension of the URL path, without the dot.
+
+    path = urllib.parse.urlsplit(url).path
+    return os.path.splitext(path)[1][1:].lower()
+
+
+
+def fieldValue(line, key):
+
+    # Value of a CDX field, plus the derived fields 'host' and 'ext'.
+
+    if key in line:
+        return str(line[key])
+    if key == 'host':
+        return hostOf(line[dictKey])
+    if key == 'ext':
+        return urlExtension(line[dictKey])
+    raise KeyError(key)
+
+
+
+def indexFilename(filename):
+    return filename + ".sqlite"
+
+
+
+def buildIndex(infile):
+
+    indexFile = indexFilename(infile)
+    tempIndex = indexFile + ".temp"
+    if os.path.exists(tempIndex):
+        os.remove(tempIndex)
+
+    print("Building index: " + indexFile)
+
+    db = sqlite3.connect(tempIndex)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute(
+            "CREATE TABLE cdx ("
+            "id INTEGER PRIMARY KEY, record TEXT, original TEXT, "
+            "timestamp TEXT, statuscode TEXT, mimetype TEXT, "
+            "host TEXT, ext TEXT, length INTEGER)"
+    )
+    db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    rows  = []
+    count = 0
+    for line in loadCDX(infile):
+        url    = line[dictKey]
+        length = str(line.get('length', ''))
+        rows.append((
+                        count,
+                        json.dumps(line, default=dict),
+                        url,
+                        str(line.get('timestamp', '')),
+                        str(line.get('statuscode', '')),
+                        str(line.get('mimetype', '')),
+                        hostOf(url),
+                        urlExtension(url),
+                        int(length) if length.isdigit() else 0,
+        ))
+        count += 1
+        if len(rows) == 10000:
+            db.executemany("INSERT INTO cdx VALUES (?,?,?,?,?,?,?,?,?)", rows)
+            rows = []
+    db.executemany("INSERT INTO cdx VALUES (?,?,?,?,?,?,?,?,?)", rows)
+
+    for column in indexColumns:  # indexes are faster to build after loading
+        db.execute(
+                "CREATE INDEX cdx_" + column + " ON cdx (" + column +
+                " COLLATE NOCASE)"
+        )
+
+    try:  # trigram full text index so substrings of any URL can be found
+        db.execute(
+                "CREATE VIRTUAL TABLE cdx_fts USING fts5("
+                "original, content='cdx', content_rowid='id', "
+                "tokenize='trigram')"
+        )
+        db.execute("INSERT INTO cdx_fts(cdx_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        print("Warning: this SQLite has no FTS5 trigram support, URL scans will not use the index.")
+
+    stat = os.stat(infile)
+    meta = {
+            'version': version,
+            'source':  os.path.abspath(infile),
+            'size':    str(stat.st_size),
+            'mtime':   str(stat.st_mtime),
+            'dictKey': str(dictKey),
+            'rows':    str(count),
+    }
+    db.executemany("INSERT INTO meta VALUES (?,?)", meta.items())
+    db.commit()
+    db.close()
+    os.replace(tempIndex, indexFile)
+
+    print("Indexed " + str(count) + " records.")
+
+
+
+def openIndex(infile):
+
+    # Returns a connection to the index of infile, or None if there is no
+    # index or the dump changed after it was built.
+
+    global dictKey
+
+    indexFile = indexFilename(infile)
+    if args['no_index'] == True or os.path.isfile(indexFile) == False:
+        return None
+
+    db = sqlite3.connect(indexFile)
+    try:
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+    except sqlite3.DatabaseError:
+        print("Warning: " + indexFile + " is not a valid index, ignoring it.\n")
+        return None
+
+    stat = os.stat(infile)
+    if meta.get('size') != str(stat.st_size) or meta.get('mtime') != str(stat.st_mtime):
+        print(
+                "Warning: " + indexFile + " is out of date, ignoring it.\n" +
+                "Run --build-index again to update it.\n"
+        )
+        db.close()
+        return None
+
+    print("Using index: " + indexFile + "\n")
+    dictKey = meta['dictKey']
+    return db
+
+
+
+def indexRecords(query, parameters=()):
+    rows = (json.loads(row[0]) for row in cdxIndex.execute(query, parameters))
+    return progressIter(statsIter('index', rows, 'records'))
+
+
+
+def scanSource(data):
+
+    # Records to scan for the current options. With an index only rows
+    # whose URL contains at least one of the search strings are read,
+    # which the FTS trigram index can find when every string is 3+ chars.
+
+    if cdxIndex == None:
+        return data
+    if jsonOutFile != "":  # every record is copied to --json-out
+        return data
+
+    terms = [string for key in options.keys() for string in options[key]]
+    hasFTS = cdxIndex.execute(
+            "SELECT count(*) FROM sqlite_master WHERE name = 'cdx_fts'"
+    ).fetchone()[0]
+    timeWhere, timeParameters = timeSQL()
+    # --collapse must see every record in the time range to keep the same
+    # ones as without the index
+    if (
+            hasFTS == 0 or collapseFields != None or
+            not terms or min(len(term) for term in terms) < 3
+    ):
+        statsCount('index_queries', 1, 'table')
+        return indexRecords(
+                "SELECT record FROM cdx WHERE " + timeWhere + " ORDER BY id",
+                timeParameters
+        )
+
+    statsCount('index_queries', 1, 'fts')
+    cdxIndex.execute("DROP TABLE IF EXISTS temp.hits")
+    cdxIndex.execute("CREATE TEMP TABLE hits (id INTEGER PRIMARY KEY)")
+    for n in range(0, len(terms), 500):  # keep each MATCH expression short
+        expression = " OR ".join(
+                '"' + term.replace('"', '""') + '"' for term in terms[n:n + 500]
+        )
+        cdxIndex.execute(
+                "INSERT OR IGNORE INTO hits "
+                "SELECT rowid FROM cdx_fts WHERE cdx_fts MATCH ?",
+                (expression,)
+        )
+
+    return indexRecords(
+            "SELECT cdx.record FROM hits JOIN cdx ON cdx.id = hits.id "
+            "WHERE " + timeWhere + " ORDER BY hits.id",
+            timeParameters
+    )
+
+
+
+def fieldSource(data, key, value):
+
+    # Records for --field. Indexed columns are looked up directly.
+
+    if cdxIndex == None:
+        return data
+    timeWhere, timeParameters = timeSQL()
+    if key in indexColumns and collapseFields == None and args['dedup_digest'] == False:
+        return indexRecords(
+                "SELECT record FROM cdx WHERE " + key + " = ? COLLATE NOCASE "
+                "AND " + timeWhere + " ORDER BY id",
+                (value,) + tuple(timeParameters)
+        )
+    return indexRecords(
+            "SELECT record FROM cdx WHERE " + timeWhere + " ORDER BY id",
+            timeParameters
+    )
+
+
+
+def enumerateIndex():
+
+    # --enumerate answered with one GROUP BY on the host index.
+
+    hosts = {}
+    timeWhere, timeParameters = timeSQL()
+    query = (
+            "SELECT host, count(*), min(timestamp), max(timestamp), sum(length) "
+            "FROM cdx WHERE " + timeWhere + " GROUP BY host ORDER BY min(id)"
+    )
+    for theHost, captures, first, last, length in cdxIndex.execute(query, timeParameters):
+        hosts[theHost] = {
+                'host':     theHost,
+                'captures': captures,
+                'first':    first,
+                'last':     last,
+                'length':   length,
+        }
+    return hosts
+
+
+
+##  PARALLEL SCAN
+##  cdf --jobs N splits the input into byte ranges (row ranges for the
+##  columnar format) that are matched by N worker processes. JSON input
+##  must hold one record per line, as written by cdx-query and cdf. The
+##  workers only match; hits, counters and --json-out records are handed
+##  back and written by the parent in input order, so the results are the
+##  same as with a single process.
+
+jobRangeMax = 32 * 1024 * 1024  # int. largest byte range given to a worker at once
+jobRowsMin  = 10000             # int. smallest row range for columnar input
+
+
+
+def recordText(line):
+    # One line of a JSON array without the brackets and comma around the record.
+    return line.strip().lstrip(b"[, \t").rstrip(b"], \t")
+
+
+
+def jobsInput(name):
+
+    # How --jobs can split the file name: 'columnar', 'lines' (one JSON
+    # record per line) or None if it can't. Sets dictKey from the first
+    # record.
+
+    global dictKey  # str.  holds URL field name from CDX file.
+
+    with open(name, 'rb') as f:
+        head = f.read(64 * 1024)
+
+    if head[:len(columnarMagic)] == columnarMagic:
+        store   = openColumnar(name)
+        dictKey = urlField(store['fields'])
+        if dictKey == None:
+            return None
+        return 'columnar'
+
+    lines = head.split(b"\n")
+    if len(head) == 64 * 1024:
+        lines = lines[:-1]  # the last line continues past the sample
+    first = None
+    for line in lines:
+        text = recordText(line)
+        if text == b"":
+            continue
+        if text[:1] != b"{" or text[-1:] != b"}":
+            return None
+        try:
+            record = json.loads(text)
+        except ValueError:
+            return None
+        if first == None:
+            first = record
+
+    if first == None:
+        return None
+    dictKey = urlField(first.keys())
+    if dictKey == None:
+        return None
+    return 'lines'
+
+
+
+def jobInit(config):
+
+    # Runs once in every worker process, config holds what jobScan() needs.
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the parent handles Ctrl-C
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # and never the sinks' handler
+
+    global matcher, negMatcher, matchKeys, neg_words, case_sensitive
+    global infile, dictKey, jsonOutFile, jobKind, cdxStore
+    global regexFilters, timeRange, hostCache
+
+    matcher        = config['matcher']
+    negMatcher     = config['negMatcher']
+    matchKeys      = config['matchKeys']
+    neg_words      = config['neg_words']
+    case_sensitive = config['case_sensitive']
+    infile         = config['infile']
+    dictKey        = config['dictKey']
+    jsonOutFile    = config['jsonOutFile']
+    jobKind        = config['jobKind']
+    regexFilters   = config['regexFilters']
+    timeRange      = config['timeRange']
+    statsEnable(config['stats'])
+    cdxStore       = None
+    hostCache      = {}
+
+
+
+def jobScan(task):
+
+    # Match one range of the input. Returns the hits as (key, url, timestamp),
+    # the records for --json-out as JSON strings, whether the file was
+    # cut off in this range, how many records were within --from/--to and
+    # the --stats counters of the range.
+
+    start, end = task
+    hits       = []
+    records    = []
+    truncated  = False
+    scanned    = 0      # int. records within --from/--to
+    cdxcommon.statsCounters.clear()  # counted again for every range
+
+    if jobKind == 'columnar':
+        store = cdxStore if cdxStore != None else openColumnar(infile)
+        urls  = store['columns'][dictKey]
+        times = store['columns']['timestamp']
+        rows  = range(start, end) if timeRange == None else columnarRows(store, start, end)
+        for row in rows:
+            scanned += 1
+            if regexFilters != None and regexMatch(ColumnarRow(store, row)) == False:
+                continue
+            url = columnValue(urls, row)
+            for key in matchedKeys(url):
+                hits.append((key, url, columnValue(times, row)))
+            if jsonOutFile != "":
+                records.append(json.dumps(ColumnarRow(store, row), default=dict))
+        return hits, records, truncated, scanned, cdxcommon.statsCounters
+
+    with open(infile, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()  # a line crossing start belongs to the previous range
+        while f.tell() < end:
+            line = f.readline()
+            if line == b"":
+                break
+            text = recordText(line)
+            if text == b"":
+                continue
+            try:
+                record = json.loads(text)
+            except ValueError:
+                if f.read(1) == b"":  # last line of an interrupted run
+                    truncated = True
+                    break
+                raise ValueError(
+                        str(infile) + " doesn't hold one JSON record per line " +
+                        "(near byte " + str(f.tell()) + ")."
+                )
+            if timeRange != None and timeMatch(record) == False:
+                continue
+            scanned += 1
+            if regexFilters != None and regexMatch(record) == False:
+                continue
+            url = record[dictKey]
+            for key in matchedKeys(url):
+                hits.append((key, url, record['timestamp']))
+            if jsonOutFile != "":
+                records.append(json.dumps(record))
+
+    return hits, records, truncated, scanned, cdxcommon.statsCounters
+
+
+
+def statsMerge(counters):
+    # Add the counters of a --jobs worker.
+    for counter, value in counters.items():
+        if isinstance(value, dict):
+            for key in value:
+                statsCount(counter, value[key], key)
+        else:
+            statsCount(counter, value)
+
+
+
+def scanJobs(name, kind):
+
+    config = {
+                'matcher':        matcher,
+                'negMatcher':     negMatcher,
+                'matchKeys':      matchKeys,
+                'neg_words':      neg_words,
+                'case_sensitive': case_sensitive,
+                'infile':         name,
+                'dictKey':        dictKey,
+                'jsonOutFile':    jsonOutFile,
+                'jobKind':        kind,
+                'regexFilters':   regexFilters,
+                'timeRange':      timeRange,
+                'stats':          cdxcommon.statsFormat,
+    }
+
+    if kind == 'columnar':
+        total = cdxStore['rows']
+        step  = max(jobRowsMin, total // (numJobs * 8) + 1)
+    else:
+        total = os.path.getsize(name)
+        step  = max(1024 * 1024, min(jobRangeMax, total // (numJobs * 8) + 1))
+    tasks = [(start, min(start + step, total)) for start in range(0, total, step)]
+    progressFile(name, lambda: progressState['read'] / max(total, 1))
+
+    with multiprocessing.Pool(numJobs, jobInit, (config,)) as pool:
+        previous = statsEnter('jobs')
+        try:
+            for task, (hits, records, truncated, scanned, counters) in zip(tasks, pool.imap(jobScan, tasks)):
+                statsMerge(counters)
+                statsCount('records', scanned)
+                if progressOn == True:
+                    progressState['records'] += scanned
+                    progressState['read']     = task[1]
+                for key, url, timestamp in hits:
+                    reportMatch(key, url, timestamp)
+                statsEnter('write')
+                for record in records:
+                    writeJSONText('json', record)
+                statsEnter('jobs')
+                if truncated == True:
+                    progressPrint(
+                            "Warning: " + str(name) + " ends early, " +
+                            "the incomplete last record was skipped.\n"
+                    )
+        except ValueError as e:
+            print("Error: " + str(e) + "\nRun without --jobs to read this file.")
+            sys.exit(1)
+        statsEnter(previous)
+
+
+
+def scanRecords(data):
+
+    # Match every record of the input against the compiled search strings.
+
+    if numJobs > 1:
+        kind = None
+        if cdxIndex != None and jsonOutFile == "":
+            print("Note: scanning with the index, --jobs is not used.\n")
+        elif collapseFields != None or args['dedup_digest'] == True:
+            # which record of a key is kept depends on the ones before it
+            print(
+                    "Note: --collapse and --dedup-digest read the input in " +
+                    "order, --jobs is not used.\n"
+            )
+        elif all(jobsInput(name) != None for name in infiles):
+            kind = 'jobs'
+        else:
+            print(
+                    "Warning: --jobs needs one JSON record per line, " +
+                    "scanning with a single process.\n"
+            )
+        if kind != None:
+            for name in infiles:
+                scanJobs(name, jobsInput(name))  # jobsInput() sets dictKey for the file
+            return
+
+    previous = statsEnter('match')
+    # for each line in the CDX file
+    for line in dedupRecords(collapseRecords(regexRecords(scanSource(data)))):
+        fileURL       = line[dictKey]  # assign keys
+        fileTimestamp = line['timestamp']
+        checkMatch(fileURL, fileTimestamp)  # scan
+        if jsonOutFile != "":  # if generating JSON
+            generateJSONList(line)  # stream record to JSON array
+    statsEnter(previous)
+
+
+
+def loadJSON(input_file):
+
+    global options  # dict
+    options = {}
+
+    try:
+        with open(input_file, 'r') as f:
+            data = json.load(f)
+    except:
+        print("Error loading or parsing JSON file.\n")
+        sys.exit(1)
+
+    keys = data[0].keys()
+
+    for key in data[0]:
+        options[key] = data[0][key].split(',')
+
+
+
+##  MERGE
+##  cdf merge a.json b.json ... -o merged.json sorts dumps of any size
+##  into one stream ordered by urlkey and timestamp. Records are read in
+##  runs of --run-size MB which are sorted in memory and written to temp
+##  files, then every run is merged at once with heapq.merge. A run line
+##  is "urlkey<tab>timestamp<tab>record" with both keys JSON escaped, so
+##  no key holds a tab and plain string order is urlkey/timestamp order.
+##  Identical records end up next to each other and are written once.
+
+mergeFanIn = 256  # int. most run files merged at once, more are merged in rounds
+
+
+
+def setMergeArgs():
+    parser = argparse.ArgumentParser(
+        description=banner(),
+        prog='cdf.py merge',
+        usage=(
+                'use "python %(prog)s --help" for more information'
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        'files',
+        metavar='JSON_FILE',
+        nargs='+',
+        help=
+                "Files to merge: JSON from the CDX server or files saved\n" +
+                "by cdx-query (--columnar too). They don't need to be\n" +
+                "sorted.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '-o',
+        '--outfile',
+        metavar='OUTPUT_FILE',
+        required=True,
+        help=
+                "JSON file for the merged records, one per line.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--run-size',
+        metavar='MB',
+        type=int,
+        default=128,
+        required=False,
+        help=
+                "Records sorted in memory at once, in MB of JSON. Memory\n" +
+                "used is a little more than this. Default: 128.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--temp-dir',
+        metavar='DIR',
+        required=False,
+        help=
+                "Directory for the sorted runs, they need about as much\n" +
+                "space as the input. Default: the system temp directory.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--keep-duplicates',
+        action='store_true',
+        required=False,
+        help=
+                "Write identical records as many times as they appear.\n"
+                + sep(),
+    )
+
+    global args
+    args = vars(parser.parse_args(sys.argv[2:]))
+
+
+
+def mergeLine(record):
+
+    # Run line of a record, see the MERGE notes.
+
+    text      = json.dumps(record, default=dict)
+    urlkey    = record['urlkey'] if 'urlkey' in record else record[dictKey]
+    timestamp = record['timestamp'] if 'timestamp' in record else ""
+    return (
+            json.dumps(str(urlkey))[1:-1] + "\t" +
+            json.dumps(str(timestamp))[1:-1] + "\t" +
+            text + "\n"
+    )
+
+
+
+def writeRun(lines, directory):
+    lines.sort()
+    handle, name = tempfile.mkstemp(prefix="run-", suffix=".txt", dir=directory)
+    with os.fdopen(handle, 'w', encoding='utf-8', buffering=sinkBuffer) as f:
+        f.writelines(lines)
+    return name
+
+
+
+def splitRuns(files, directory):
+
+    # Sorted run files of every input, each about --run-size MB.
+
+    runs  = []
+    lines = []
+    size  = 0
+    limit = args['run_size'] * 1024 * 1024
+    for name in files:
+        for record in loadCDX(name):
+            line = mergeLine(record)
+            lines.append(line)
+            size += len(line)
+            if size >= limit:
+                runs.append(writeRun(lines, directory))
+                lines = []
+                size  = 0
+    if lines:
+        runs.append(writeRun(lines, directory))
+    return runs
+
+
+
+def openRuns(runs):
+    return [open(name, 'r', encoding='utf-8', buffering=sinkBuffer) for name in runs]
+
+
+
+def mergeRounds(runs, directory):
+
+    # Merge groups of runs until at most mergeFanIn are left, so the
+    # number of open files stays bounded.
+
+    while len(runs) > mergeFanIn:
+        merged = []
+        for n in range(0, len(runs), mergeFanIn):
+            group = runs[n:n + mergeFanIn]
+            files = openRuns(group)
+            handle, name = tempfile.mkstemp(prefix="run-", suffix=".txt", dir=directory)
+            with os.fdopen(handle, 'w', encoding='utf-8', buffering=sinkBuffer) as f:
+                f.writelines(heapq.merge(*files))
+            for f in files:
+                f.close()
+            for old in group:
+                os.remove(old)
+            merged.append(name)
+        runs = merged
+    return runs
+
+
+
+def mergeDumps():
+
+    setMergeArgs()
+
+    for name in args['files']:
+        if os.path.exists(name) == False:
+            print("Error: file " + str(name) + " doesn't exist.")
+            sys.exit(1)
+    if args['outfile'] in args['files']:
+        print("Error: You cannot use the same output name as an input file.")
+        sys.exit(1)
+    if args['run_size'] < 1:
+        print("Error: --run-size must be at least 1.\n")
+        sys.exit(1)
+    if os.path.isfile(args['outfile']):
+        overwrite = input("File: " + str(args['outfile']) + " exists. Overwrite (y/n)? ")
+        if overwrite.lower() != "y":
+            sys.exit(0)
+
+    global cdxStore  # dict. set by loadCDX() for columnar input
+    cdxStore = None
+
+    records = 0  # int. records written
+    dupes   = 0  # int. identical records skipped
+    with tempfile.TemporaryDirectory(prefix="cdf-merge-", dir=args['temp_dir']) as directory:
+        runs = splitRuns(args['files'], directory)
+        print("Sorted " + str(len(runs)) + " runs, merging.")
+        runs  = mergeRounds(runs, directory)
+        files = openRuns(runs)
+        try:
+            with open(args['outfile'], 'w', encoding='utf-8', buffering=sinkBuffer) as out:
+                out.write("[")
+                previous = None
+                for line in heapq.merge(*files):
+                    if line == previous and args['keep_duplicates'] == False:
+                        dupes += 1
+                        continue
+                    previous = line
+                    out.write(("\n" if records == 0 else ",\n") + line.split("\t", 2)[2][:-1])
+                    records += 1
+                out.write("\n]")
+        finally:
+            for f in files:
+                f.close()
+
+    print(
+            "Merged " + str(records) + " records into " + str(args['outfile']) +
+            ", skipped " + str(dupes) + " duplicates." +
+            "\nExecution time: " + str(time.time() - startTime) + " seconds"
+    )
+
+
+
+
+def main():
+
+    try:
+        if sys.argv[1] == "-v" or sys.argv[1] == "--version":
+            print("cdx-filter v" + version)
+            sys.exit(0)
+    except:
+        print("Expected at least 1 argument. --help for help.")
+        sys.exit(1)
+
+    statsStart(startTime, statsOrder)
+
+    if sys.argv[1] == "merge":
+        mergeDumps()
+        sys.exit(0)
+
+    setArgs()
+
+    global infile    #str. input file
+    global outfile   #str. output file
+
+    global cdxStore   # dict. set by loadCDX() for columnar input
+    cdxStore = None
+    global hostCache  # dict. URL prefix -> host, see hostOf()
+    hostCache = {}
+
+    statsEnter('index')
+
+    if args['build_index'] == True:
+        buildIndex(infile)
+        printStats('cdx-filter', version)
+        sys.exit(0)
+
+    global cdxIndex   # sqlite3 connection to the index of infile, or None
+    cdxIndex = None
+    if len(infiles) == 1:  # an index covers a single file
+        cdxIndex = openIndex(infile)
+
+    statsEnter('other')
+    progressStart()
+
+    data = loadInputs(timeFilter=True)  # generator, records are streamed on demand
+    data = statsIter('parse', data, 'records')
+    data = progressIter(data)
+    if cdxcommon.statsOn == True:
+        statsCount('input_bytes', sum(os.path.getsize(name) for name in infiles))
+
+    global options
+    options = {}
+    global options_count
+    options_count = {}
+    global scanLINES  #int.  counts found items
+    scanLINES = 0
+    global textLINES  #int.  counts found items
+    textLINES = 0
+    global scanType   #str.  tracks which type of search is being performed
+    scanType = None
+    global neg_words  #list. contains negative search words
+    neg_words = []
+    global filterLINES #int. counts found items
+    filterLINES = 0
+    global dedupLINES #int.  captures dropped by --dedup-digest
+    dedupLINES = 0
+    global regexFilters  #dict. compiled --regex, None without it
+    regexFilters = None
+    if args['regex'] != None:
+        regexFilters = compileRegex(args['regex'])
+    global collapseFields  #list. (field, length) for --collapse, None without it
+    collapseFields = None
+    if args['collapse'] != None:
+        collapseFields = compileCollapse(args['collapse'])
+
+    ##  --enumerate search, writes its own file so no sink is opened
+    if args['enumerate'] != None:
+        statsEnter('enumerate')
+        if (
+                cdxIndex != None and regexFilters == None and
+                collapseFields == None and args['dedup_digest'] == False
+        ):
+            hosts = enumerateIndex()
+        else:
+            hosts = enumerateHosts(dedupRecords(collapseRecords(regexRecords(data))))
+        progressStop()
+        with open(str(args['enumerate']), 'w') as f:
+            if args['enum_format'] == 'json':
+                f.write(
+                        '[\n' +
+                        ',\n'.join(json.dumps(hosts[h]) for h in hosts) +
+                        '\n]'
+                )
+            else:
+                for h in hosts:
+                    f.write(
+                            h + " " +
+                            str(hosts[h]['captures']) + " " +
+                            str(hosts[h]['first']) + " " +
+                            str(hosts[h]['last']) + " " +
+                            str(hosts[h]['length']) + "\n"
+                    )
+        print(
+              "Found " + (str(len(hosts))) + " hosts.\n" +
+              "List saved to: " + str(args['enumerate']) + "\n"
+        )
+        printStats('cdx-filter', version)
+        sys.exit(0)
+
+    openSinks()
+
+    if args['make_html'] != None:
+        formatHTML()
+
+
+    ##  --exclude negative keywords.  build list of negative search keywords
+    if args['exclude'] != None:
+        neg_words = args['exclude'].split(',')  # split input string into list
+
+    ##  --textfile search
+    if args['textfile'] != None:
+        scanType = 'textfile'
+        textInputFile = args['textfile']
+        with open(textInputFile, 'r') as tfile:
+            allstrings = tfile.read()  # read is probably fine for this
+            parseLines = allstrings.split('\n')  # remove empty/space/newline
+            textStrings = [line for line in parseLines if line.strip()]
+            options['textfile'] = textStrings  # copy list to options dict
+        compileMatcher()
+        scanRecords(data)
+
+    ##  --json search
     if args['json'] != None:
         scanType = 'json'
         loadJSON(args['json'])
@@ -619,53 +2555,37 @@ def main():
         jsonCounter = {}
         for key in options.keys():
             jsonCounter[key] = 0  # fill dict with 0's to start counter at
-        count = 0
-        for line in data:  # for each line in the CDX file
-            fileURL       = data[count][dictKey]  # assign keys
-            fileTimestamp = data[count]['timestamp']
-            checkMatch(fileURL, fileTimestamp)  # scan
-            if jsonOutFile != "":  # if generating JSON
-                generateJSONList(line)  # write line to temp file
-            count += 1
-        if jsonOutFile != "":  # if generating JSON
-            convertListToJSON()  # write final JSON file
+        compileMatcher()
+        scanRecords(data)
 
     ##  --scan search
     if args['scan'] != None:
         scanType = 'scan'
         scanList = args['scan'].split(',')  # split input string into list
         options['scan'] = scanList          # add the list to the dict to scan
-        count = 0
-        for line in data:
-            fileURL       = data[count][dictKey]
-            fileTimestamp = data[count]['timestamp']
-            checkMatch(fileURL, fileTimestamp)
-            if jsonOutFile != "":  # if generating JSON
-                generateJSONList(line)  # write line to temp file
-            count += 1
-        if jsonOutFile != "":  # if generating JSON
-           convertListToJSON()  # write final JSON file
+        compileMatcher()
+        scanRecords(data)
 
-    ##  --enumerate search
-    if args['enumerate'] != None:
-        global subhostlist
-        subhostList = []
-        count = 0
-        for line in data:
-            fileURL = data[count][dictKey]
-            theHost = urllib.parse.urlsplit(fileURL)
-            theHost = theHost.netloc
-            if theHost not in subhostList:
-                subhostList.append(theHost)
-            count += 1
-        with open(str(args['enumerate']), 'w') as f:
-            for line in subhostList:
-                f.write(line + "\n")
-        print(
-              "Found " + (str(len(subhostList))) + " hosts.\n" +
-              "List saved to: " + str(args['enumerate']) + "\n"
-        )
-        sys.exit(0)
+    ##  --regex/--from/--to/--collapse on their own, every record that
+    ##  passes the filters is a result
+    if (
+            (
+                args['regex']    != None or
+                args['from']     != None or
+                args['to']       != None or
+                args['collapse'] != None or
+                args['dedup_digest'] == True
+            ) and
+            args['scan']      == None and
+            args['textfile']  == None and
+            args['json']      == None and
+            args['field']     == None and
+            args['enumerate'] == None
+    ):
+        scanType = 'filter'
+        options['filter'] = [""]  # the empty string matches every URL
+        compileMatcher()
+        scanRecords(data)
 
     ##  --field search
     if args['field'] != None:
@@ -678,38 +2598,37 @@ def main():
         else:
             fieldOUT = False
 
-        count = 0
-
-        for line in data:
+        statsEnter('match')
+        for line in dedupRecords(collapseRecords(regexRecords(
+                fieldSource(data, fieldList[0], fieldList[1])
+        ))):
             if case_sensitive == False:  # if case insensitive
                 searchVal = fieldList[1].lower()
-                dataLine  = data[count][fieldList[0]].lower()
+                dataLine  = fieldValue(line, fieldList[0]).lower()
             else:  # case sensitive
                 searchVal = fieldList[1]
-                dataLine  = data[count][fieldList[0]]
+                dataLine  = fieldValue(line, fieldList[0])
             if searchVal == dataLine:
+                statsEnter('write')
+                if progressOn == True:
+                    progressState['matches'] += 1
                 if args['quiet'] == False:  # if not suppressing output
-                    print(line)  # print it
+                    progressPrint(line)  # print it
                 if fieldOUT == True:  # if --outfile specified
-                    with open(args['outfile'], 'a') as f:
-                        f.write(json.dumps(line) + "\n")
+                    writeJSONSink('outfile', line)
+                statsEnter('match')
                 fieldLINES += 1
-            count += 1
+                if cdxcommon.statsOn == True:
+                    statsCount('matches', 1, fieldList[0] + "=" + fieldList[1])
+        statsEnter('other')
 
         if fieldOUT == True:
-            flist = []
-            with open(args['outfile']) as f:
-                for line in f:
-                    flist.append(json.loads(line))
-            with open(args['outfile'], 'w') as fp:
-                fp.write(
-                            '[\n' +
-                            ',\n'.join(json.dumps(i) for i in flist) +
-                            '\n]'
-                )
+            closeSink('outfile')
 
 
     ##  RESULTS
+    progressStop()
+    closeSink('list')
     print("\nScan complete.")
 
     if case_sensitive == True:
@@ -718,6 +2637,9 @@ def main():
         msg = "Performed case insensitive search."
     print(msg)
 
+    if args['dedup_digest'] == True:
+        print("Dropped " + str(dedupLINES) + " duplicate captures (same digest and URL).")
+
     if scanType == 'json':
         print("\nResults:")
         print(json.dumps(jsonCounter, indent=4)+"\n")
@@ -729,6 +2651,8 @@ def main():
         countType = textLINES
     if scanType == 'field':
         countType = fieldLINES
+    if scanType == 'filter':
+        countType = filterLINES
     if scanType == 'json':
         for jsonkey in jsonCounter:
             countType += jsonCounter[jsonkey]
@@ -763,15 +2687,17 @@ def main():
                </html>
                """
         data = textwrap.dedent(data)
-        with open(htmlfile, 'a') as f:
-            f.write(data + "\n")
+        writeSink('html', data + "\n")
 
+        closeSink('html')
         print(
                 "\n"
                 + "HTML file list saved as " + str(args['make_html'])
         )
 
-    if "~" in args['scan']:  # warn on tilde usage in case Wayback saved encoded URL
+    closeSinks()
+
+    if args['scan'] != None and "~" in args['scan']:  # warn on tilde usage in case Wayback saved encoded URL
         print(
               "\nI see you used a ~ in your search query.\n"
             + "You may also want to search ussing the URL encoded version, too.\n"
@@ -780,6 +2706,8 @@ def main():
 
     # do we need to warn for other encoded characters?
 
+    printStats('cdx-filter', version)
+
 
 if __name__ == '__main__':
     main()
@@ -4,16 +4,34 @@
 import time
 startTime = time.time()
 import argparse
+import asyncio
+import cdxcommon
 import datetime
+import gzip
+import ijson
+import io
+import itertools
 import json
 import logging
 import os
+import queue
 import random
+import re
 import requests
+import shutil
+import struct
 import sys
+import tempfile
 import threading
 import urllib.parse
-
+import zlib
+
+from cdxcommon import chunkSize, cacheSetup, cacheGet, cachePut
+from cdxcommon import statsStart, statsEnable, statsEnter, statsCount
+from cdxcommon import statsIter, statsAsyncIter, printStats
+from cdxcommon import progressStart, progressAdd, progressStop, progressPrint
+from cdxcommon import textKeys, textRecords, gunzipChunks, rawChunks
+from cdxcommon import clientSetup, requestHeaders, closeAsyncPool, fetch_cdx, asyncBody
 from pathlib import Path
 from urllib.parse import urlparse
 from urllib.parse import unquote
@@ -23,6 +41,11 @@ from urllib.parse import urlencode
 
 version = '1.1b'
 
+statsOrder = (  # tuple. --stats phases in report order
+                    'import', 'setup', 'network', 'cache', 'parse', 'write', 'other'
+)
+
+
 #-----------------------------------#
 #         cdx-query by av1d         #
 #-----------------------------------#
@@ -44,11 +67,6 @@ def sep():
     return "------------\n"
 
 
-def progress():
-    sys.stdout.write(".")
-    sys.sleep(1)
-
-
  #########################################
   ####  ARGUMENT PARSING / SYNTAX CHECKING
 def setup():
@@ -67,7 +85,7 @@ def setup():
         '-u',
         '--url',
         metavar='URL',
-        required=True,
+        required=False,
         help=
                 "The URL to search for.\n"
                 + sep(),
@@ -281,10 +299,318 @@ def setup():
                 "Using showDupeCount will only show unique captures.\n"
                 + sep(),
     )
+    # multiple targets
+    parser.add_argument(
+        '--url-file',
+        metavar='FILE',
+        required=False,
+        help=
+                "Query every URL in FILE (one per line, # for comments)\n"
+                + "with the same options instead of --url. Targets are\n"
+                + "fetched in parallel (see --workers) over one shared\n"
+                + "connection pool. Use --out for one combined file or\n"
+                + "--out-dir for one file per target. A per-target\n"
+                + "summary is printed at the end.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--out-dir',
+        metavar='DIRECTORY',
+        required=False,
+        help=
+                "With --url-file, save each target to its own file in\n"
+                + "DIRECTORY. Existing files are overwritten.\n"
+                + sep(),
+    )
+    # pagination
+    parser.add_argument(
+        '-p',
+        '--pages',
+        action='store_true',
+        required=False,
+        help=
+                "Use the pagination API. The number of pages is fetched\n"
+                + "first with showNumPages, then every page is downloaded\n"
+                + "in parallel and written to --out in order.\n"
+                + "Recommended for very large domains.\n"
+                + "Note: collapsing is applied by the server per page.\n"
+                + sep(),
+    )
+    # page size
+    parser.add_argument(
+        '--page-size',
+        metavar='BLOCKS',
+        type=int,
+        required=False,
+        help=
+                "Size of each page in index blocks (use with --pages).\n"
+                + "Default is the server default.\n"
+                + sep(),
+    )
+    # page workers
+    parser.add_argument(
+        '-w',
+        '--workers',
+        metavar='NUMBER',
+        type=int,
+        required=False,
+        help=
+                "Number of pages or --url-file targets to download\n"
+                + "at the same time. Default: 4, or 50 with\n"
+                + "--engine asyncio.\n"
+                + sep(),
+    )
+    # fetch engine
+    parser.add_argument(
+        '--engine',
+        choices=['requests', 'asyncio'],
+        default='requests',
+        required=False,
+        help=
+                "HTTP engine. 'requests' uses a thread per worker,\n"
+                + "'asyncio' keeps every request on one thread and\n"
+                + "suits --url-file with thousands of small lookups.\n"
+                + "Not available with --pages or --batch.\n"
+                + "Default: requests.\n"
+                + sep(),
+    )
+    # timeout
+    parser.add_argument(
+        '--timeout',
+        metavar='SECONDS',
+        type=int,
+        default=60,
+        required=False,
+        help=
+                "HTTP response timeout in seconds. Default: 60.\n"
+                + sep(),
+    )
+    # cache
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        required=False,
+        help=
+                "Don't read or write the local response cache.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        required=False,
+        help=
+                "Always query the server, then update the cache.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        metavar='SECONDS',
+        type=int,
+        default=86400,
+        required=False,
+        help=
+                "Cached responses older than this are fetched again.\n"
+                + "Default: 86400 (1 day).\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        type=int,
+        default=1024,
+        required=False,
+        help=
+                "Maximum size of the cache in megabytes. The least\n"
+                + "recently used responses are removed first.\n"
+                + "Default: 1024.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIRECTORY',
+        required=False,
+        help=
+                "Cache directory, shared by cdx-query and cdxpress.\n"
+                + "Default: ~/.cache/cdx-tools\n"
+                + sep(),
+    )
+    # columnar output
+    parser.add_argument(
+        '--columnar',
+        action='store_true',
+        required=False,
+        help=
+                "Save --out in a compact binary columnar format\n"
+                + "instead of JSON. Much smaller and faster to scan\n"
+                + "with cdx-filter. Not available with --batch.\n"
+                + sep(),
+    )
+    # text format
+    parser.add_argument(
+        '--text',
+        action='store_true',
+        required=False,
+        help=
+                "Ask the server for the plain text CDX format instead\n"
+                + "of JSON. It is smaller and is parsed line by line,\n"
+                + "--out is still saved as JSON (or --columnar).\n"
+                + sep(),
+    )
+    # resumable batches
+    parser.add_argument(
+        '-b',
+        '--batch',
+        metavar='NUMBER',
+        type=int,
+        required=False,
+        help=
+                "Download the results in batches of NUMBER records\n"
+                + "using the server's resumeKey. After each batch a\n"
+                + "checkpoint is saved so an interrupted download can be\n"
+                + "continued with --resume. Requires --out.\n"
+                + sep(),
+    )
+    # checkpoint file
+    parser.add_argument(
+        '--checkpoint',
+        metavar='FILE',
+        required=False,
+        help=
+                "Checkpoint filename for --batch.\n"
+                + "Default: the --out filename + '.checkpoint'.\n"
+                + sep(),
+    )
+    # stats
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=['text', 'json'],
+        required=False,
+        help=
+                "When done, print to stderr how long each phase took\n"
+                + "(import, setup, network, cache, parse, write) and\n"
+                + "counters: requests, records, bytes received and\n"
+                + "bytes written. --stats json prints them as JSON.\n"
+                + sep(),
+    )
+    # resume
+    parser.add_argument(
+        '--resume',
+        metavar='CHECKPOINT',
+        required=False,
+        help=
+                "Continue an interrupted --batch download from its\n"
+                + "checkpoint file. No other arguments are needed.\n"
+                + "Example: --resume results.txt.checkpoint\n"
+                + sep(),
+    )
 
     global args
     args = vars(parser.parse_args())
 
+    ###################################
+    ##  fetch options, these are not CDX parameters
+    global usePages    # bool. use the pagination API
+    global pageSize    # int.  pageSize parameter, None for server default
+    global numWorkers  # int.  concurrent page downloads
+    global timeoutSEC  # int.  http timeout in seconds
+    global useAsync    # bool. fetch with the asyncio engine
+    usePages   = args.pop('pages')
+    pageSize   = args.pop('page_size')
+    numWorkers = args.pop('workers')
+    timeoutSEC = args.pop('timeout')
+    useAsync   = args.pop('engine') == 'asyncio'
+    if numWorkers == None:
+        numWorkers = 50 if useAsync == True else 4
+    clientSetup("cdx-query/" + version, numWorkers)
+
+    cacheMode = 'use'  # str. 'use', 'refresh' or 'off'
+    if args.pop('refresh_cache') == True:
+        cacheMode = 'refresh'
+    if args.pop('no_cache') == True:
+        cacheMode = 'off'
+    cacheSetup(
+                cacheMode,
+                args.pop('cache_ttl'),
+                args.pop('cache_size') * 1024 * 1024,
+                args.pop('cache_dir')
+    )
+
+    statsEnable(args.pop('stats'))  # print --stats when done
+
+    if numWorkers < 1:
+        print("--- Error: --workers must be at least 1.")
+        sys.exit(1)
+    if pageSize != None and pageSize < 1:
+        print("--- Error: --page-size must be at least 1.")
+        sys.exit(1)
+
+    global useColumnar  # bool. write --out in the columnar format
+    useColumnar = args.pop('columnar')
+
+    global batchSize       # int. records per resumeKey batch, None if unused
+    global checkpointFile  # str. checkpoint filename for --batch
+    global resumeFile      # str. checkpoint to resume from
+    batchSize      = args.pop('batch')
+    checkpointFile = args.pop('checkpoint')
+    resumeFile     = args.pop('resume')
+
+    global urlFile    # str. --url-file, None for a single --url
+    global outputDir  # str. --out-dir, None for a single output file
+    urlFile   = args.pop('url_file')
+    outputDir = args.pop('out_dir')
+
+    if useAsync == True and (usePages == True or batchSize != None or resumeFile != None):
+        print("--- Error: --engine asyncio cannot be used with --pages, --batch or --resume.")
+        sys.exit(1)
+
+    if resumeFile != None:  # everything else comes from the checkpoint
+        if os.path.isfile(resumeFile) == False:
+            print("--- Error: checkpoint " + str(resumeFile) + " doesn't exist.")
+            sys.exit(1)
+        return
+
+    if urlFile != None:
+        if args['url'] != None:
+            print("--- Error: --url and --url-file cannot be used at the same time.")
+            sys.exit(1)
+        if os.path.isfile(urlFile) == False:
+            print("--- Error: file " + str(urlFile) + " doesn't exist.")
+            sys.exit(1)
+        if outputDir != None and args['out'] != None:
+            print("--- Error: --out and --out-dir cannot be used at the same time.")
+            sys.exit(1)
+        if usePages == True or batchSize != None:
+            print("--- Error: --url-file cannot be used with --pages or --batch.")
+            sys.exit(1)
+        args['url'] = ""  # replaced by each target
+    elif outputDir != None:
+        print("--- Error: --out-dir requires --url-file.")
+        sys.exit(1)
+
+    if args['url'] == None:
+        parser.error("the following arguments are required: -u/--url")
+
+    if batchSize != None:
+        if batchSize < 1:
+            print("--- Error: --batch must be at least 1.")
+            sys.exit(1)
+        if args['out'] == None:
+            print("--- Error: --batch requires --out.")
+            sys.exit(1)
+        if usePages == True:
+            print("--- Error: --batch and --pages cannot be used at the same time.")
+            sys.exit(1)
+        if args['limit'] != None:
+            print("--- Error: --batch and --limit cannot be used at the same time.")
+            sys.exit(1)
+        if useColumnar == True:
+            print("--- Error: --batch and --columnar cannot be used at the same time.")
+            sys.exit(1)
+        if checkpointFile == None:
+            checkpointFile = args['out'] + ".checkpoint"
+
     ###################################
     ##  check output file
     if args['out'] != None:
@@ -424,8 +750,7 @@ def setup():
     ##
     ##  for ease of use
 
-    args['output'] = 'json'
-    args['gzip'] = 'false'
+    args['output'] = 'text' if args.pop('text') == True else 'json'
 
     if args['matchtype'] == None:  # pay attn to letter case
         args['matchType'] = 'domain'
@@ -500,6 +825,9 @@ def setup():
     filtered = {k: v for k, v in args.items() if v is not None}
     filtered = {k: v for k, v in filtered.items() if v is not False}
 
+    global cdxKeys  # list. columns of the text format, None for JSON
+    cdxKeys = textKeys(filtered)
+
 
  ########################################
   ####  FILE NAMES
@@ -522,10 +850,15 @@ def checkFileExistence(filename):
 def constructURL():
 
     global URL  # str.  final URL
-    
+
+    URL = buildURL(filtered)
+
+
+def buildURL(params):
+
     searchurl = "https://web.archive.org/cdx/search/cdx?"
     
-    mainParams = filtered  # modified dict with no 'None' or 'False' values
+    mainParams = params  # modified dict with no 'None' or 'False' values
     mainParams = urlencode(mainParams)
     parameters = mainParams
 
@@ -539,7 +872,7 @@ def constructURL():
     if inexclude != None and regex != None:
         addonParams1 = "&filter=" + str(inexclude)
         addonParams2 = "&filter=" + str(regex)
-        parameters = mainParams + addonParams
+        parameters = mainParams + addonParams1 + addonParams2
     else:  # check if only one was specified
         if inexclude !=None:                           # if --include or --exclude
             addonParams = "&filter=" + str(inexclude)  # contruct parameter string
@@ -552,79 +885,407 @@ def constructURL():
     
     encodedURL = parameters           # URL with percent encoding
     rawURL     = unquote(encodedURL)  # URL without percent encoding
-    URL        = searchurl + rawURL   # final URL
+    return searchurl + rawURL         # final URL
 
 
  ########################################
   ####  Convert API response
-   ###  Turn the JSON response into one dictionary per line.
+   ###  Turn the JSON or text response into one dictionary per line.
     ##  The result is still valid JSON.
-def cdxToDict(cdx_response):
+def cdxToDict(cdx_file):
 
-    n = json.loads(cdx_response)
-    
-    keys = []  # holds JSON keys
+    # Generator: parse the saved response incrementally and yield one
+    # dictionary per row, so the response is never held in memory.
 
-    if not n:  # if list is empty...
-        print("\n--- Error: Response file is empty. Likely the URL provided is invalid or is not archived.")
-        print("The response file was saved at: " + str(tempFilename) + " and can be examined.\n")
+    msg = "The response file was saved at: " + str(cdx_file) + " and can be examined.\n"
+
+    if cdxKeys != None:  # text format, read line by line
+        with open(cdx_file, 'r', encoding='utf-8') as f:
+            records = textRecords(f, cdxKeys)
+            first   = next(records, None)
+            if first == None:
+                print("\n--- Error: Response file is empty. Likely the URL provided is invalid or is not archived.")
+                print(msg)
+                sys.exit(1)
+            yield first
+            yield from records
+        return
+
+    try:
+        with open(cdx_file, 'rb') as f:
+            rows = ijson.items(f, 'item', use_float=True)
+            keys = next(rows, None)  # first row holds the JSON keys
+
+            if not keys:  # if list is empty...
+                print("\n--- Error: Response file is empty. Likely the URL provided is invalid or is not archived.")
+                print(msg)
+                sys.exit(1)
+
+            yield from cdxRecords(keys, rows)
+    except ijson.JSONError:
+        print("\n--- Error: An unknown error has occurred. The response is not valid JSON.\n")
+        print(msg)
         sys.exit(1)
 
-    for i in n[0]:
-        try:
-            keys.append(i)  # add the keys to the list
-        except:
-            print("\n--- Error: An unknown error has occurred. The response is missing the appropriate keys.\n")
-            print("The response file was saved at: " + str(tempFilename) + " and can be examined.\n")
-            sys.exit(1)
 
-    x = [dict(zip(keys, l)) for l in n]  # create list of dictionaries
-    x.pop(0)  # remove first line containing JSON keys
-    
-    final_out = '[\n' + ',\n'.join(json.dumps(i) for i in x) + '\n]'  # format list
+def cdxRecords(keys, rows):
 
-    return(final_out)
+    # Generator: zip the key row with each value row. Records go straight
+    # to the writer, there is no intermediate list or JSON string.
 
+    for row in rows:
+        yield dict(zip(keys, row))
 
- ########################################
-  ####  FETCH RESPONSE
-def fetchResponse():
 
-    timeoutSEC = 60  # http timeout in seconds
+def parseResponse(body):
 
-    if args["url"] != None:  # create a unique filename
+    # Records and resume key (None without one) of a response held in
+    # memory, in either format.
 
-        print("Fetching: " + URL)
-        print("Response timeout set to: " + str(timeoutSEC) + " seconds")
+    if cdxKeys != None:
+        lines = body.rstrip("\n").split("\n")
+        resumeKey = None
+        if len(lines) >= 2 and lines[-2] == "":  # empty line, then the resume key
+            resumeKey = lines.pop()
+            lines.pop()
+        return textRecords(lines, cdxKeys), resumeKey
 
-        # construct user agent header
-        clientVersion = "cdx-query/" + version
-        headers = {"User-Agent": clientVersion}
+    rows, resumeKey = splitResumeKey(json.loads(body))
+    if rows:
+        return cdxRecords(rows[0], itertools.islice(rows, 1, None)), resumeKey
+    return [], resumeKey
 
-        #Download the response
-        try:
-            response = requests.get(
-                                        URL,
-                                        headers=headers,
-                                        timeout=timeoutSEC,
-                                        stream=True
+
+def fileRecords(f):
+
+    # Generator: records of a response saved in the binary file f, in
+    # either format, parsed incrementally. An empty response has none.
+
+    if cdxKeys != None:
+        yield from textRecords(io.TextIOWrapper(f, encoding='utf-8'), cdxKeys)
+        return
+
+    rows = ijson.items(f, 'item', use_float=True)
+    keys = next(rows, None)  # first row holds the JSON keys
+    if keys:
+        yield from cdxRecords(keys, rows)
+
+
+def writeRecords(out_file, records, count):
+
+    # Append records to an open JSON array. count is the number of records
+    # already in the array, the new total is returned.
+
+    for record in records:
+        if count > 0:
+            out_file.write(',\n')
+        out_file.write(json.dumps(record))
+        count += 1
+
+    return count
+
+
+ ########################################
+  ####  COLUMNAR OUTPUT
+   ###  Compact binary alternative to the JSON array (--columnar).
+    ##  All integers are little-endian.
+    ##
+    ##  header:    b"CDXC", u16 version, u16 columns, u64 rows,
+    ##             u64 directory offset, padded to 32 bytes
+    ##  columns:   each one starts on an 8 byte boundary
+    ##    BLOB     u64 offsets[rows + 1], then the UTF-8 bytes of every value
+    ##    FIXED    rows * width bytes, values padded with spaces
+    ##    DICT     u64 offsets[count + 1] and the bytes of each distinct
+    ##             value, padded to 8 bytes, then u32 ids[rows]
+    ##  directory: per column u16 name length, name, u8 kind, u8 derived,
+    ##             u32 width (FIXED) or count (DICT), u64 offset, u64 size
+    ##
+    ##  timestamp and statuscode are FIXED, mimetype is a DICT, everything
+    ##  else is a BLOB. A derived DICT column "host" holds the host of
+    ##  every original URL. When every timestamp has 14 digits, a derived
+    ##  FIXED column "timestamp_blocks" (width 28) holds the smallest and
+    ##  largest timestamp of each block of columnarBlock rows, so
+    ##  cdx-filter --from/--to skips blocks out of range without reading
+    ##  them. cdx-filter reads the file with mmap.
+columnarMagic   = b"CDXC"
+columnarVersion = 1
+columnarBLOB    = 1
+columnarFIXED   = 2
+columnarDICT    = 3
+columnarBlock   = 4096  # rows per entry of timestamp_blocks, same in cdf.py
+columnarKinds   = {
+                    'timestamp':  columnarFIXED,
+                    'statuscode': columnarFIXED,
+                    'mimetype':   columnarDICT,
+                    'host':       columnarDICT,
+}
+
+
+def openColumnar(filename):
+
+    # Values are spilled to one temporary file per column while the
+    # records stream in, the final file is assembled by closeColumnar().
+
+    return {
+            'filename': filename,
+            'fields':   None,  # list. CDX keys, taken from the first record
+            'columns':  {},
+            'blocks':   [],    # list. [smallest, largest] timestamp of each block, None if not 14 digits
+    }
+
+
+def addColumn(store, name, derived):
+
+    kind   = columnarKinds.get(name, columnarBLOB)
+    column = {
+                'kind':    kind,
+                'derived': derived,
+                'width':   0,
+    }
+    if kind == columnarDICT:
+        column['table'] = {}  # value -> id
+        column['ids']   = tempfile.TemporaryFile()
+    else:  # FIXED columns are spilled like a BLOB, widths are known at the end
+        column['ends'] = tempfile.TemporaryFile()
+        column['data'] = tempfile.TemporaryFile()
+        column['size'] = 0
+    store['columns'][name] = column
+
+
+def writeColumnar(store, records, count):
+
+    # Same contract as writeRecords(): returns the new record count.
+
+    for record in records:
+        if store['fields'] == None:
+            store['fields'] = list(record.keys())
+            for name in store['fields']:
+                addColumn(store, name, False)
+            if 'original' in store['fields']:
+                addColumn(store, 'host', True)
+
+        values = [(name, str(record.get(name, ''))) for name in store['fields']]
+        if 'original' in store['fields']:
+            values.append(('host', urlparse(record['original']).netloc))
+
+        if store['blocks'] != None:
+            stamp = str(record.get('timestamp', ''))
+            if len(stamp) != 14 or stamp.isascii() == False:
+                store['blocks'] = None  # blocks compare as 14 digit strings only
+            elif count % columnarBlock == 0:
+                store['blocks'].append([stamp, stamp])
+            elif stamp < store['blocks'][-1][0]:
+                store['blocks'][-1][0] = stamp
+            elif stamp > store['blocks'][-1][1]:
+                store['blocks'][-1][1] = stamp
+
+        for name, value in values:
+            column = store['columns'][name]
+            if column['kind'] == columnarDICT:
+                valueID = column['table'].setdefault(value, len(column['table']))
+                column['ids'].write(struct.pack('<I', valueID))
+            else:
+                data = value.encode('utf-8')
+                column['size'] += len(data)
+                column['width'] = max(column['width'], len(data))
+                column['data'].write(data)
+                column['ends'].write(struct.pack('<Q', column['size']))
+        count += 1
+
+    store['count'] = count
+    return count
+
+
+def alignColumnar(out_file):
+    out_file.write(b"\0" * (-out_file.tell() % 8))
+
+
+def copyColumnar(spill, out_file):
+    spill.seek(0)
+    shutil.copyfileobj(spill, out_file, chunkSize)
+    spill.close()
+
+
+def closeColumnar(store):
+
+    rows      = store.get('count', 0)
+    directory = []
+
+    with open(store['filename'], 'wb') as out_file:
+        out_file.write(b"\0" * 32)  # header is written last
+
+        for name in store['columns']:
+            column = store['columns'][name]
+            alignColumnar(out_file)
+            start = out_file.tell()
+
+            if column['kind'] == columnarBLOB:
+                param = 0
+                out_file.write(struct.pack('<Q', 0))
+                copyColumnar(column['ends'], out_file)
+                copyColumnar(column['data'], out_file)
+
+            elif column['kind'] == columnarFIXED:
+                param = column['width']
+                column['ends'].seek(0)
+                column['data'].seek(0)
+                previous = 0
+                for n in range(rows):
+                    end  = struct.unpack('<Q', column['ends'].read(8))[0]
+                    data = column['data'].read(end - previous)
+                    out_file.write(data.ljust(param, b" "))
+                    previous = end
+                column['ends'].close()
+                column['data'].close()
+
+            else:  # columnarDICT
+                table = list(column['table'].keys())  # in id order
+                param = len(table)
+                ends  = [0]
+                for value in table:
+                    ends.append(ends[-1] + len(value.encode('utf-8')))
+                out_file.write(struct.pack('<' + str(len(ends)) + 'Q', *ends))
+                for value in table:
+                    out_file.write(value.encode('utf-8'))
+                alignColumnar(out_file)
+                copyColumnar(column['ids'], out_file)
+
+            directory.append((name, column, param, start, out_file.tell() - start))
+
+        if 'timestamp' in store['columns'] and store['blocks'] != None:
+            alignColumnar(out_file)
+            start = out_file.tell()
+            for smallest, largest in store['blocks']:
+                out_file.write((smallest + largest).encode('ascii'))
+            blocks = {'kind': columnarFIXED, 'derived': True}
+            directory.append(('timestamp_blocks', blocks, 28, start, out_file.tell() - start))
+
+        directoryOffset = out_file.tell()
+        for name, column, param, start, size in directory:
+            encodedName = name.encode('utf-8')
+            out_file.write(struct.pack('<H', len(encodedName)) + encodedName)
+            out_file.write(
+                    struct.pack(
+                                '<BBIQQ',
+                                column['kind'],
+                                column['derived'],
+                                param,
+                                start,
+                                size
+                    )
             )
 
-        except requests.exceptions.Timeout:
-            raise SystemExit("Connection timed out")
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
+        out_file.seek(0)
+        out_file.write(
+                struct.pack(
+                            '<4sHHQQ',
+                            columnarMagic,
+                            columnarVersion,
+                            len(directory),
+                            rows,
+                            directoryOffset
+                )
+        )
 
-        if str(response.status_code) == "200":
-            print("Received HTTP status: ", response.status_code, response.reason, " - connected to server.")
 
-        global status_code
-        status_code = str(response.status_code)
-        if status_code != "200":  # exit unless 200
-            print("Received HTTP status: " + status_code)
-            sys.exit(0)
+def statsOutput(filename):
+    if cdxcommon.statsOn == True and os.path.isfile(filename):
+        statsCount('output_bytes', os.path.getsize(filename))
+
+
+def openOutput(filename):
+
+    # Output file handle for the JSON array or, with --columnar, the
+    # columnar store.
+
+    if useColumnar == True:
+        return openColumnar(filename)
+
+    out_file = open(filename, 'w')
+    out_file.write('[\n')
+    return out_file
 
-        print("Fetching the response may take a long time, do not stop the program...")
+
+def writeOutput(out, records, count):
+    previous = statsEnter('write')
+    if useColumnar == True:
+        count = writeColumnar(out, records, count)
+    else:
+        count = writeRecords(out, records, count)
+    statsEnter(previous)
+    return count
+
+
+def closeOutput(out):
+    previous = statsEnter('write')
+    if useColumnar == True:
+        closeColumnar(out)
+        statsOutput(out['filename'])
+    else:
+        out.write('\n]')
+        out.close()
+        statsOutput(out.name)
+    statsEnter(previous)
+
+
+ ########################################
+  ####  FETCH RESPONSE
+def downloadResponse():
+
+    print("Response timeout set to: " + str(timeoutSEC) + " seconds")
+
+    # construct user agent header
+    clientVersion = "cdx-query/" + version
+    headers = {"User-Agent": clientVersion}
+
+    #Download the response
+    previous = statsEnter('network')
+    statsCount('requests')
+    try:
+        response = session.get(
+                                    URL,
+                                    headers=headers,
+                                    timeout=timeoutSEC,
+                                    stream=True
+        )
+
+    except requests.exceptions.Timeout:
+        raise SystemExit("Connection timed out")
+    except requests.exceptions.RequestException as e:
+        raise SystemExit(e)
+    statsEnter(previous)
+
+    if str(response.status_code) == "200":
+        print("Received HTTP status: ", response.status_code, response.reason, " - connected to server.")
+
+    global status_code
+    status_code = str(response.status_code)
+    if status_code != "200":  # exit unless 200
+        print("Received HTTP status: " + status_code)
+        sys.exit(0)
+
+    print("Fetching the response may take a long time, do not stop the program...")
+
+    # stream the body to disk in chunks, save in case it crashes processing
+    progressStart()
+    try:
+        with open(tempFilename, 'wb') as f:
+            chunks = statsIter('network', rawChunks(response), 'bytes_received')
+            for chunk in gunzipChunks(chunks):
+                f.write(chunk)
+    except (requests.exceptions.RequestException, zlib.error) as e:
+        progressStop()
+        print("\n--- Error: download interrupted: " + str(e))
+        print("The partial response was saved at: " + str(tempFilename) + "\n")
+        sys.exit(1)
+    progressStop()
+
+
+def fetchResponse():
+
+    if args["url"] != None:  # create a unique filename
+
+        print("Fetching: " + URL)
 
         # create temporary filename with random hash to avoid
         # temp file conflicts when running concurrent instances
@@ -633,33 +1294,650 @@ def fetchResponse():
         hash2 = "%032x" % hash1         # format
         tempFilename = "cdx-" + str(hash2) + ".temp"
 
-        with open(tempFilename, 'w') as f:  # save in case it crashes processing
-            f.write(str(response.content))
+        cached = cacheGet(URL)
+        if cached != None:
+            print("Using cached response: " + cached)
+            previous = statsEnter('cache')
+            with gzip.open(cached, 'rb') as src, open(tempFilename, 'wb') as f:
+                shutil.copyfileobj(src, f, chunkSize)
+            statsEnter(previous)
+        else:
+            downloadResponse()
+            previous = statsEnter('cache')
+            with open(tempFilename, 'rb') as f:
+                cachePut(URL, f)
+            statsEnter(previous)
 
         print("Response saved to temporary file: " + tempFilename + "\nProcessing file...")
 
-        cdx_out = cdxToDict(response.text)
+        records = cdxToDict(tempFilename)  # converted one row at a time
+        records = statsIter('parse', records, 'records')
+        count   = 0
 
         if outputFile != "":
-
+            first = next(records, None)  # checks the response before creating the file
+            if first != None:
+                records = itertools.chain([first], records)
             print("Saving as: " + outputFile)
+            out   = openOutput(outputFile)
+            count = writeOutput(out, records, count)
+            closeOutput(out)
+            print("Done. " + str(count) + " records saved.")
+        else:
+            for record in records:  # still parse it to validate the response
+                count += 1
+            print("Parsed " + str(count) + " records.")
+
+
+
+ ########################################
+  ####  PAGINATION
+   ###  Ask the server how many pages the query has, download them
+    ##  with a bounded pool of threads and write them out in order.
+def openSession():
+
+    # One keep-alive session for every request, so connections and TLS
+    # handshakes are reused across pages, batches and targets.
+
+    global session
+    session = requests.Session()
+    session.headers.update(requestHeaders())
+    adapter = requests.adapters.HTTPAdapter(
+                                                pool_connections=4,
+                                                pool_maxsize=max(numWorkers, 10)
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def fetchFile(url, body):
+
+    # Stream the response of url into the binary file object body chunk
+    # by chunk, from the cache if possible. A failed attempt is discarded
+    # and retried, so body only ever holds one complete response.
 
-            with open(outputFile, 'w') as out_file:  # save it
-                out_file.write(cdx_out)
+    pageRetries = 3  # attempts per page before giving up
 
-                print("Done.")  
+    cached = cacheGet(url)
+    if cached != None:
+        previous = statsEnter('cache')
+        with gzip.open(cached, 'rb') as f:
+            shutil.copyfileobj(f, body, chunkSize)
+        statsEnter(previous)
+        return
 
+    previous = statsEnter('network')
+    for attempt in range(1, pageRetries + 1):
+        statsCount('requests')
+        body.seek(0)
+        body.truncate()
+        try:
+            response = session.get(
+                                        url,
+                                        headers=requestHeaders(),
+                                        timeout=timeoutSEC,
+                                        stream=True
+            )
+            with response:
+                if response.status_code == 200:
+                    chunks = statsIter('network', rawChunks(response), 'bytes_received')
+                    for chunk in gunzipChunks(chunks):
+                        body.write(chunk)
+                    statsEnter('cache')
+                    body.seek(0)
+                    cachePut(url, body)
+                    statsEnter(previous)
+                    return
+            error = "HTTP status " + str(response.status_code)
+        except (requests.exceptions.RequestException, zlib.error) as e:
+            error = str(e)
+        if attempt < pageRetries:
+            time.sleep(attempt * 2)
+
+    statsEnter(previous)
+    raise SystemExit("--- Error: failed to fetch " + url + " (" + error + ")")
+
+
+def fetchPage(pageURL):
+    body = io.BytesIO()
+    fetchFile(pageURL, body)
+    return body.getvalue().decode('utf-8')
+
+
+def fetchNumPages():
+
+    numPagesURL = URL + "&showNumPages=true"
+    if pageSize != None:
+        numPagesURL = numPagesURL + "&pageSize=" + str(pageSize)
+
+    print("Fetching: " + numPagesURL)
+    try:
+        numPages = int(fetchPage(numPagesURL).strip())
+    except ValueError:
+        print("--- Error: the server did not return a page count.")
+        sys.exit(1)
+
+    return numPages
+
+
+def pageWorker():
+
+    # Takes page numbers from pageQueue until it is empty. A worker never
+    # runs more than pageWindow pages ahead of the writer so memory stays
+    # bounded while the writer waits on a slow page.
+
+    while True:
+        try:
+            page = pageQueue.get_nowait()
+        except queue.Empty:
+            return
+
+        with pageCondition:
+            while page >= nextPage + pageWindow:
+                pageCondition.wait()
+
+        pageURL = URL + "&page=" + str(page)
+        if pageSize != None:
+            pageURL = pageURL + "&pageSize=" + str(pageSize)
+
+        try:
+            result = fetchPage(pageURL)
+        except BaseException as e:  # handed to the writer which exits
+            result = e
+
+        with pageCondition:
+            pageResults[page] = result
+            pageCondition.notify_all()
+
+
+def fetchPages():
+
+    global pageQueue      # queue. page numbers left to download
+    global pageResults    # dict.  page number -> response text
+    global pageCondition  # threading.Condition. guards pageResults/nextPage
+    global nextPage       # int.   next page the writer is waiting for
+    global pageWindow     # int.   max pages held in memory at once
+
+    numPages = fetchNumPages()
+    print(
+            "The server reports " + str(numPages) + " page(s). "
+            + "Downloading with " + str(numWorkers) + " worker(s)..."
+    )
+
+    pageQueue     = queue.Queue()
+    pageResults   = {}
+    pageCondition = threading.Condition()
+    nextPage      = 0
+    pageWindow    = numWorkers * 2
+
+    for page in range(numPages):
+        pageQueue.put(page)
+
+    for n in range(min(numWorkers, numPages)):
+        worker = threading.Thread(target=pageWorker, daemon=True)
+        worker.start()
+
+    if outputFile != "":
+        out = openOutput(outputFile)
+
+    totalRecords = 0
+    progressStart('pages', numPages)
+
+    for page in range(numPages):
+        previous = statsEnter('network')  # waiting for the workers
+        with pageCondition:
+            while page not in pageResults:
+                pageCondition.wait()
+            result = pageResults.pop(page)
+            nextPage = page + 1
+            pageCondition.notify_all()
+
+        if isinstance(result, BaseException):
+            progressStop()
+            print(result)
+            sys.exit(1)
+
+        statsEnter('parse')
+        records, resumeKey = parseResponse(result)
+        records = statsIter('parse', records, 'records')
+        statsEnter(previous)
+        before = totalRecords
+
+        if outputFile != "":
+            totalRecords = writeOutput(out, records, totalRecords)
+        else:
+            totalRecords += sum(1 for record in records)
+
+        progressAdd(done=1)
+        progressPrint(
+                "Page " + str(page + 1) + "/" + str(numPages)
+                + ": " + str(totalRecords - before) + " records."
+        )
+
+    progressStop()
+    if outputFile != "":
+        closeOutput(out)
+        print("Saved " + str(totalRecords) + " records as: " + outputFile)
+
+    if totalRecords == 0:
+        print("\n--- Warning: No records returned. Likely the URL provided is invalid or is not archived.")
+
+
+ ########################################
+  ####  ASYNCIO ENGINE
+   ###  --engine asyncio runs the queries on the client in cdxcommon.py,
+    ##  whose fetch_cdx() is also the Python API of cdq:
+    ##
+    ##      async for record in cdq.fetch_cdx({'url': 'example.org'}):
+    ##          print(record['original'])
+
+
+async def asyncResponse(out):
+    count = 0
+    try:
+        async for record in statsAsyncIter('parse', fetch_cdx(URL, timeoutSEC), 'records'):
+            if out != None:
+                count = writeOutput(out, [record], count)
+            else:
+                count += 1
+    finally:
+        await closeAsyncPool()
+    return count
+
+
+def fetchAsync():
+
+    print("Fetching: " + URL)
+
+    out = None
+    if outputFile != "":
+        print("Saving as: " + outputFile)
+        out = openOutput(outputFile)
+    progressStart()
+    try:
+        count = asyncio.run(asyncResponse(out))
+    except (OSError, asyncio.TimeoutError, zlib.error) as e:
+        progressStop()
+        print("--- Error: " + (str(e) or type(e).__name__))
+        sys.exit(1)
+    progressStop()
+    if out != None:
+        closeOutput(out)
+        print("Done. " + str(count) + " records saved.")
+    else:
+        print("Parsed " + str(count) + " records.")
+
+    if count == 0:
+        print("\n--- Warning: No records returned. Likely the URL provided is invalid or is not archived.")
+
+
+ ########################################
+  ####  MULTIPLE TARGETS
+   ###  --url-file: every target is queried with the same parameters
+    ##  through the shared keep-alive session by a bounded pool of worker
+    ##  threads. Output goes to one file per target (--out-dir) or to one
+    ##  combined file (--out).
+def normalizeTarget(target):
+
+    # same clean up setup() does for --url
+    target = target.replace("http://", "").replace("https://", "")
+    if "?" in target:
+        target = urllib.parse.quote_plus(target)
+    return target
+
+
+def loadTargets(filename):
+
+    targets = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and line.startswith("#") == False:  # skip blanks and comments
+                targets.append(line)
+    return targets
+
+
+def targetFilename(target):
+
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', target).strip('_')
+    if name == "":
+        name = "target"
+    if useColumnar == True:
+        return os.path.join(outputDir, name + ".cdxc")
+    return os.path.join(outputDir, name + ".json")
+
+
+def targetWorker():
+
+    while True:
+        try:
+            index, target = targetQueue.get_nowait()
+        except queue.Empty:
+            return
+
+        # streamed to a temporary file like a single --url response, so
+        # a large target is never held in memory and the lock for the
+        # combined file is only taken once the download is complete
+        try:
+            params = dict(filtered, url=normalizeTarget(target))
+            with tempfile.TemporaryFile() as body:
+                fetchFile(buildURL(params), body)
+                body.seek(0)
+                count = writeTarget(target, statsIter('parse', fileRecords(body), 'records'))
+            result = ("ok", count, "")
+        except BaseException as e:  # reported in the summary
+            result = ("FAILED", 0, str(e))
+
+        with targetLock:
+            targetResults[index] = result
+            progressAdd(done=1)
+            progressPrint(result[0] + ": " + target + " (" + str(result[1]) + " records)")
+
+
+def writeTarget(target, records):
+
+    # Write the records of one target, returns how many there were.
+
+    global combinedCount
+
+    if outputDir != None:
+        out   = openOutput(targetFilename(target))
+        count = writeOutput(out, records, 0)
+        closeOutput(out)
+    elif outputFile != "":
+        with targetLock:  # one target at a time in the combined file
+            before        = combinedCount
+            combinedCount = writeOutput(combinedOut, records, combinedCount)
+            count         = combinedCount - before
+    else:
+        count = sum(1 for record in records)
+
+    return count
+
+
+def fetchTargets():
+
+    global targetQueue    # queue. (index, target) left to query
+    global targetResults  # dict.  index -> (status, records, error)
+    global targetLock     # threading.Lock. guards output and results
+    global combinedOut    # combined output for --out
+    global combinedCount  # int.   records in the combined output
+
+    targets = loadTargets(urlFile)
+    print(
+            "Querying " + str(len(targets)) + " target(s) with "
+            + str(numWorkers) + " worker(s)..."
+    )
+
+    targetQueue   = queue.Queue()
+    targetResults = {}
+    targetLock    = threading.Lock()
+    combinedCount = 0
+
+    for index, target in enumerate(targets):
+        targetQueue.put((index, target))
+
+    if outputDir != None:
+        os.makedirs(outputDir, exist_ok=True)
+    elif outputFile != "":
+        combinedOut = openOutput(outputFile)
+
+    workers = []
+    for n in range(min(numWorkers, len(targets))):
+        worker = threading.Thread(target=targetWorker, daemon=True)
+        worker.start()
+        workers.append(worker)
+    progressStart('targets', len(targets))
+    previous = statsEnter('network')  # waiting for the workers
+    for worker in workers:
+        worker.join()
+    statsEnter(previous)
+    progressStop()
+
+    if outputDir == None and outputFile != "":
+        closeOutput(combinedOut)
+
+    return printSummary(targets)
+
+
+async def asyncTarget(index, target):
+
+    try:
+        params = dict(filtered, url=normalizeTarget(target))
+        url    = buildURL(params)
+        if outputDir != None:
+            out   = openOutput(targetFilename(target))
+            count = 0
+            async for record in statsAsyncIter('parse', fetch_cdx(url, timeoutSEC), 'records'):
+                count = writeOutput(out, [record], count)
+            closeOutput(out)
+        elif outputFile != "":
+            # streamed to a temporary file like in targetWorker(), each
+            # target is copied into the combined file once it is complete
+            with tempfile.TemporaryFile() as body:
+                async for chunk in asyncBody(url, timeoutSEC):
+                    body.write(chunk)
+                body.seek(0)
+                count = writeTarget(target, statsIter('parse', fileRecords(body), 'records'))
+        else:
+            count = 0
+            async for record in statsAsyncIter('parse', fetch_cdx(url, timeoutSEC), 'records'):
+                count += 1
+        result = ("ok", count, "")
+    except Exception as e:  # reported in the summary
+        result = ("FAILED", 0, str(e) or type(e).__name__)
+
+    targetResults[index] = result
+    progressAdd(done=1)
+    progressPrint(result[0] + ": " + target + " (" + str(result[1]) + " records)")
+
+
+async def asyncTargets(targets):
+    try:
+        await asyncio.gather(*[asyncTarget(index, target) for index, target in enumerate(targets)])
+    finally:
+        await closeAsyncPool()
+
+
+def fetchTargetsAsync():
+
+    global targetResults  # dict. index -> (status, records, error)
+    global targetLock     # threading.Lock. guards the combined output
+    global combinedOut    # combined output for --out
+    global combinedCount  # int.  records in the combined output
+
+    targets = loadTargets(urlFile)
+    print(
+            "Querying " + str(len(targets)) + " target(s) with up to "
+            + str(numWorkers) + " concurrent request(s)..."
+    )
+
+    targetResults = {}
+    targetLock    = threading.Lock()
+    combinedCount = 0
+
+    if outputDir != None:
+        os.makedirs(outputDir, exist_ok=True)
+    elif outputFile != "":
+        combinedOut = openOutput(outputFile)
+
+    progressStart('targets', len(targets))
+    try:
+        asyncio.run(asyncTargets(targets))
+    finally:
+        progressStop()
+
+    if outputDir == None and outputFile != "":
+        closeOutput(combinedOut)
+
+    return printSummary(targets)
+
+
+def printSummary(targets):
+
+    failed  = 0
+    records = 0
+    print("\nSummary:")
+    for index, target in enumerate(targets):
+        status, count, error = targetResults[index]
+        line = status.ljust(7) + str(count).rjust(10) + "  " + target
+        if status != "ok":
+            line = line + "  (" + error + ")"
+            failed += 1
+        records += count
+        print(line)
+    print(
+            "\n" + str(len(targets) - failed) + " succeeded, "
+            + str(failed) + " failed, " + str(records) + " records."
+    )
+    if outputDir != None:
+        print("Saved one file per target in: " + outputDir)
+    elif outputFile != "":
+        print("Saved as: " + outputFile)
+
+    return failed
+
+
+ ########################################
+  ####  RESUMABLE BATCHES
+   ###  Fetch the query in batches of batchSize records with showResumeKey.
+    ##  After each batch the output is synced to disk and a checkpoint
+    ##  with the query, the last resume key and the output offset is saved.
+def saveCheckpoint(resumeKey, offset, records):
+
+    checkpoint = {
+                    'version':   version,
+                    'url':       URL,
+                    'out':       os.path.abspath(outputFile),
+                    'batch':     batchSize,
+                    'resumeKey': resumeKey,
+                    'offset':    offset,
+                    'records':   records,
+    }
+
+    tempCheckpoint = checkpointFile + ".temp"
+    with open(tempCheckpoint, 'w') as f:
+        f.write(json.dumps(checkpoint, indent=4))
+    os.replace(tempCheckpoint, checkpointFile)  # never leave a half written checkpoint
+
+
+def loadCheckpoint():
+
+    global URL             # str. query URL, without batch parameters
+    global outputFile      # str. output filename
+    global batchSize       # int. records per batch
+    global checkpointFile  # str. checkpoint filename
+
+    try:
+        with open(resumeFile, 'r') as f:
+            checkpoint = json.load(f)
+        URL        = checkpoint['url']
+        outputFile = checkpoint['out']
+        batchSize  = checkpoint['batch']
+        checkpoint['resumeKey']
+        checkpoint['offset']
+        checkpoint['records']
+    except (ValueError, KeyError, TypeError):
+        print("--- Error: " + str(resumeFile) + " is not a valid checkpoint file.")
+        sys.exit(1)
+
+    if os.path.isfile(outputFile) == False:
+        print("--- Error: output file " + str(outputFile) + " from the checkpoint doesn't exist.")
+        sys.exit(1)
+
+    checkpointFile = resumeFile
+
+    global cdxKeys  # list. columns of the text format, None for JSON
+    cdxKeys = textKeys(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(URL).query)))
+
+    return checkpoint
+
+
+def splitResumeKey(rows):
+
+    # With showResumeKey the response ends with an empty row followed by
+    # a row holding the resume key. Returns (rows, resumeKey or None).
+
+    if len(rows) >= 2 and rows[-2] == [] and len(rows[-1]) == 1:
+        return rows[:-2], rows[-1][0]
+
+    return rows, None
+
+
+def fetchBatches():
+
+    if resumeFile != None:
+        checkpoint = loadCheckpoint()
+        resumeKey  = checkpoint['resumeKey']
+        offset     = checkpoint['offset']
+        records    = checkpoint['records']
+        print(
+                "Resuming: " + URL + "\n"
+                + "Continuing " + outputFile + " after " + str(records) + " records."
+        )
+        raw = open(outputFile, 'r+b')
+        raw.seek(offset)
+        raw.truncate()  # drop anything written after the checkpoint
+    else:
+        resumeKey = None
+        records   = 0
+        raw       = open(outputFile, 'wb')
+        raw.write(b'[\n')
+        offset    = raw.tell()
+        saveCheckpoint(resumeKey, offset, records)
+        print("Checkpoint file: " + checkpointFile)
+
+    out_file = io.TextIOWrapper(raw, encoding='utf-8')  # raw keeps the byte offset
+    progressStart('batches')
+
+    while True:
+        batchURL = URL + "&showResumeKey=true&limit=" + str(batchSize)
+        if resumeKey != None:
+            batchURL = batchURL + "&resumeKey=" + urllib.parse.quote(unquote(resumeKey), safe='')
+
+        body     = fetchPage(batchURL)
+        previous = statsEnter('parse')
+        batch, resumeKey = parseResponse(body)
+        batch    = statsIter('parse', batch, 'records')
+        statsEnter('write')
+        records  = writeRecords(out_file, batch, records)
+
+        out_file.flush()
+        os.fsync(raw.fileno())  # output must be on disk before the checkpoint
+        offset = raw.tell()
+        statsEnter(previous)
+
+        if resumeKey == None:  # no more results
+            break
+
+        saveCheckpoint(resumeKey, offset, records)
+        progressAdd(done=1)
+        progressPrint("Saved " + str(records) + " records, checkpoint updated.")
+
+    progressStop()
+    out_file.write('\n]')
+    out_file.close()
+    os.remove(checkpointFile)
+    statsOutput(outputFile)
+
+    print("Saved " + str(records) + " records as: " + outputFile)
+
+    if records == 0:
+        print("\n--- Warning: No records returned. Likely the URL provided is invalid or is not archived.")
 
 
  ########################################
   ####  MAIN
 def main():
 
+    statsStart(startTime, statsOrder)
+
     logging.basicConfig(
         format="%(pathname)s line%(lineno)s: %(message)s",
         level=logging.INFO
     )
 
+    urlLoc = None
     if "--url" in sys.argv:
         urlLoc = sys.argv.index("--url") + 1
     elif "-u" in sys.argv:
@@ -668,17 +1946,38 @@ def main():
         if "*" in sys.argv[urlLoc]:
             print("--- Warning: Ensure strings with asterisks are enclosed in single quotes.")
 
+    global tempFilename
+    tempFilename = ""
+
     setup()
-    constructURL()
-    fetchResponse()
+    openSession()
+    statsEnter('other')
+    failed = 0
+    if resumeFile != None:
+        fetchBatches()
+    elif urlFile != None and useAsync == True:
+        failed = fetchTargetsAsync()
+    elif urlFile != None:
+        failed = fetchTargets()
+    else:
+        constructURL()
+        if usePages == True:
+            fetchPages()
+        elif batchSize != None:
+            fetchBatches()
+        elif useAsync == True:
+            fetchAsync()
+        else:
+            fetchResponse()
 
     executionTime = (time.time() - startTime)
 
-    print("Cleaning up temporary files...")
-    if os.path.exists(tempFilename):
-      os.remove(tempFilename)
-    else:
-      print("Temp file " + tempFilename + " not found. Ignoring...")
+    if tempFilename != "":
+        print("Cleaning up temporary files...")
+        if os.path.exists(tempFilename):
+          os.remove(tempFilename)
+        else:
+          print("Temp file " + tempFilename + " not found. Ignoring...")
     
     print(
             "\nExecution time: "
@@ -686,6 +1985,11 @@ def main():
             + " seconds"
     )
 
+    printStats('cdx-query', version)
+
+    if failed > 0:
+        sys.exit(1)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,898 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import gzip
+import hashlib
+import ijson
+import json
+import os
+import random
+import requests
+import shutil
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+import urllib3
+import zlib
+
+
+
+#-----------------------------------#
+#    shared code of the cdx-tools   #
+#-----------------------------------#
+# https://github.com/av1d/cdx-tools #
+#-----------------------------------#
+
+# Imported by cdq.py, cdf.py and cdxpress.py, keep it in the same
+# directory as them.
+
+chunkSize = 64 * 1024  # int. bytes read from the network or a file per chunk
+
+
+ ########################################
+  ####  PROGRESS
+   ###  While a download runs and stdout is a terminal, a daemon thread
+    ##  redraws one line on stderr a few times a second: bytes received,
+    ##  transfer rate and how many of unit are done. The download itself
+    ##  only adds to the counters with progressAdd(), progressPrint() is
+    ##  print() for messages shown meanwhile.
+progressOn       = False             # bool. a progress line is shown
+progressInterval = 0.25              # float. seconds between two redraws
+progressState    = {}                # dict. counters of the running download
+progressLock     = threading.Lock()  # guards progressState and the line
+
+
+def progressStart(unit=None, total=None):
+
+    # unit names what progressAdd(done=...) counts, shown with the total
+    # if it is known.
+
+    global progressOn
+    if sys.stdout.isatty() == False:
+        return
+    progressState.update({
+                            'received': 0,
+                            'done':     0,
+                            'unit':     unit,
+                            'total':    total,
+                            'start':    time.time(),
+                            'stop':     threading.Event(),
+    })
+    progressOn = True
+    threading.Thread(target=progressLoop, args=(progressState['stop'],), daemon=True).start()
+
+
+def progressAdd(received=0, done=0):
+    if progressOn == True:
+        with progressLock:
+            progressState['received'] += received
+            progressState['done']     += done
+
+
+def progressSize(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size = size / 1024
+    return "%.1f GB" % size
+
+
+def progressLine():
+    elapsed = max(time.time() - progressState['start'], 0.001)
+    line    = (
+                "Received " + progressSize(progressState['received'])
+                + " at " + progressSize(progressState['received'] / elapsed) + "/s"
+    )
+    if progressState['unit'] != None:
+        line = line + ", " + str(progressState['done'])
+        if progressState['total'] != None:
+            line = line + "/" + str(progressState['total'])
+        line = line + " " + progressState['unit']
+    return line
+
+
+def progressLoop(stop):
+    while stop.wait(progressInterval) == False:
+        with progressLock:
+            if stop.is_set() == False:
+                sys.stderr.write("\r" + progressLine() + "\033[K")
+                sys.stderr.flush()
+
+
+def progressStop():
+    global progressOn
+    if progressOn == False:
+        return
+    progressOn = False
+    with progressLock:
+        progressState['stop'].set()
+        sys.stderr.write("\r\033[K")  # leave nothing behind
+        sys.stderr.flush()
+
+
+def progressPrint(text):
+
+    # print() for messages shown during a download, the progress line is
+    # cleared first and redrawn below them.
+
+    if progressOn == False:
+        print(text)
+        return
+    with progressLock:
+        sys.stderr.write("\r\033[K")
+        sys.stderr.flush()
+        print(text)
+
+
+ ########################################
+  ####  RESPONSE CACHE
+   ###  Responses are kept gzip-compressed in cacheDir, one file per fully
+    ##  built CDX URL, named by its SHA-256. A file's mtime is when it was
+    ##  stored (checked against the TTL) and its atime is when it was last
+    ##  used (oldest is evicted first once the cache outgrows cacheSize).
+    ##  The size of the cache is counted once per run and then kept up to
+    ##  date as entries are added, the directory is only scanned again to
+    ##  evict. Eviction trims the cache to cacheTrim of cacheSize, so a full
+    ##  cache isn't scanned again on every new entry.
+cacheMode  = 'off'             # str. 'use', 'refresh' or 'off', replaced by cacheSetup()
+cacheDir   = None              # str. cache directory
+cacheTTL   = 0                 # int. seconds a cached response stays fresh
+cacheSize  = 0                 # int. cache size limit in bytes
+cacheTrim  = 0.9               # float. share of cacheSize left after an eviction
+cacheTotal = None              # int. bytes in cacheDir, None until first counted
+cacheLock  = threading.Lock()  # guards cacheTotal and eviction
+
+
+def cacheSetup(mode, ttl, size, directory=None):
+    global cacheMode, cacheTTL, cacheSize, cacheDir
+    cacheMode = mode
+    cacheTTL  = ttl
+    cacheSize = size
+    cacheDir  = directory
+    if cacheDir == None:
+        cacheDir = cacheDefaultDir()
+
+
+def cacheDefaultDir():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cdx-tools')
+
+
+def cachePath(url):
+    return os.path.join(cacheDir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".gz")
+
+
+def cacheTempPath(url):
+    os.makedirs(cacheDir, exist_ok=True)
+    return cachePath(url) + "." + "%032x" % random.getrandbits(128) + ".temp"
+
+
+def cacheGet(url):
+
+    # Path of a fresh cached response for url, or None.
+
+    if cacheMode != 'use':
+        return None
+
+    path = cachePath(url)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if time.time() - stat.st_mtime > cacheTTL:
+        return None
+
+    os.utime(path, (time.time(), stat.st_mtime))  # mark as recently used
+    return path
+
+
+def cachePut(url, source):
+
+    # Compress everything left in the binary file object source into the
+    # cache entry for url.
+
+    if cacheMode == 'off':
+        return
+
+    tempPath = cacheTempPath(url)
+    with gzip.open(tempPath, 'wb', compresslevel=6) as f:
+        shutil.copyfileobj(source, f, chunkSize)
+    cacheAdd(tempPath, url)
+
+
+def cacheChunks(chunks, url):
+
+    # Generator: pass the response chunks through while a compressed copy
+    # is written to the cache. The entry is only added if the download
+    # completes.
+
+    if cacheMode == 'off':
+        yield from chunks
+        return
+
+    tempPath = cacheTempPath(url)
+    complete = False
+    try:
+        with gzip.open(tempPath, 'wb', compresslevel=6) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        cacheAdd(tempPath, url)
+        complete = True
+    finally:
+        if complete == False and os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+async def asyncCacheChunks(chunks, url):
+
+    # Same as cacheChunks() for an async iterator of chunks.
+
+    if cacheMode == 'off':
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    tempPath = cacheTempPath(url)
+    complete = False
+    try:
+        with gzip.open(tempPath, 'wb', compresslevel=6) as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        cacheAdd(tempPath, url)
+        complete = True
+    finally:
+        if complete == False and os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+def cacheAdd(tempPath, url):
+
+    # Move a complete entry into place and add it to the running total,
+    # evicting once the cache outgrows cacheSize.
+
+    global cacheTotal
+
+    path = cachePath(url)
+    size = os.path.getsize(tempPath)
+    with cacheLock:
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(tempPath, path)  # readers never see a half written entry
+        if cacheTotal == None:
+            cacheTotal = cacheEvict()  # first entry of the run, count them all
+        else:
+            cacheTotal += size - replaced
+            if cacheTotal > cacheSize:
+                cacheTotal = cacheEvict()
+
+
+def cacheEvict():
+
+    # Scan cacheDir, remove the least recently used entries if it is over
+    # cacheSize and return the size that is left. Called with cacheLock.
+
+    entries = []
+    for name in os.listdir(cacheDir):
+        if name.endswith(".gz") == False:
+            continue
+        try:
+            stat = os.stat(os.path.join(cacheDir, name))
+        except OSError:  # removed by another instance
+            continue
+        entries.append((stat.st_atime, stat.st_size, name))
+
+    total = sum(entry[1] for entry in entries)
+    if total <= cacheSize:
+        return total
+
+    for atime, size, name in sorted(entries):  # least recently used first
+        if total <= cacheSize * cacheTrim:
+            break
+        try:
+            os.remove(os.path.join(cacheDir, name))
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+ ########################################
+  ####  RESPONSE DECODING
+   ###  The body is decompressed chunk by chunk as it arrives, the text
+    ##  format is split into records line by line.
+textFields      = (  # tuple. columns of the text format without fl
+                    'urlkey', 'timestamp', 'original', 'mimetype',
+                    'statuscode', 'digest', 'length'
+)
+textExtraFields = (  # tuple. (option, column it appends)
+                    ('showDupeCount', 'dupecount'),
+                    ('showSkipCount', 'skipcount'),
+                    ('lastSkipTimestamp', 'endtimestamp')
+)
+
+
+def gunzip(state, chunk):
+
+    # Decompress a response body one chunk at a time as it arrives. The
+    # server may send gzip with or without Content-Encoding, so gzip is
+    # recognised by its magic number and anything else passes through.
+    # state is an empty dict kept between calls, chunk is None at the end.
+
+    if 'decompressor' not in state:
+        head = state.get('head', b"") + (chunk or b"")
+        if len(head) < 2 and chunk != None:
+            state['head'] = head
+            return b""
+        if head[:2] != b"\x1f\x8b":
+            state['decompressor'] = None  # plain body
+            return head
+        state['decompressor'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunk = head
+
+    decompressor = state['decompressor']
+    if decompressor == None:
+        return chunk or b""
+    if chunk == None:
+        if decompressor.eof == False:
+            raise zlib.error("compressed response is incomplete")
+        return b""
+
+    data = decompressor.decompress(chunk)
+    while decompressor.eof == True and decompressor.unused_data != b"":  # next gzip member
+        rest         = decompressor.unused_data
+        decompressor = state['decompressor'] = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data        += decompressor.decompress(rest)
+    return data
+
+
+def gunzipChunks(chunks):
+    state = {}
+    for chunk in chunks:
+        data = gunzip(state, chunk)
+        if data:
+            yield data
+    data = gunzip(state, None)
+    if data:
+        yield data
+
+
+def rawChunks(response):
+
+    # Like iter_content() but leaves the body compressed, it is decoded by
+    # gunzipChunks() on the way to the parser.
+
+    try:
+        for chunk in response.raw.stream(chunkSize, decode_content=False):
+            progressAdd(received=len(chunk))
+            yield chunk
+    except (urllib3.exceptions.HTTPError, OSError) as e:
+        raise requests.exceptions.ConnectionError(e)
+
+
+def textKeys(params):
+
+    # Column names for a query in the text format (output=text), or None
+    # for JSON. JSON names its columns in the first row, text does not,
+    # so they follow from fl and the options that add a column.
+
+    if params.get('output') != 'text':
+        return None
+
+    if 'fl' in params:
+        keys = params['fl'].split(',')
+    else:
+        keys = list(textFields)
+    for param, key in textExtraFields:
+        if str(params.get(param)).lower() == 'true':
+            keys.append(key)
+
+    return keys
+
+
+def textLines(state, chunk):
+
+    # Complete lines received so far, a partial last line waits in state
+    # (an empty dict kept between calls) for the next chunk. chunk is
+    # None at the end.
+
+    if chunk == None:
+        block = state.pop('pending', b"")
+    else:
+        block, newline, state['pending'] = (state.get('pending', b"") + chunk).rpartition(b"\n")
+
+    return block.decode('utf-8').split("\n")
+
+
+def textRecords(lines, keys):
+
+    # Generator: one dictionary per line of the text format. split() stops
+    # at the last column so only a plain split per line is needed.
+
+    last = len(keys) - 1
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line != "":
+            yield dict(zip(keys, line.split(" ", last)))
+
+
+ ########################################
+  ####  ASYNCIO CLIENT
+   ###  Alternative to requests (--engine asyncio): a small HTTP/1.1 client
+    ##  on asyncio streams with a keep-alive connection pool, so thousands
+    ##  of CDX requests can be in flight on one thread. At most asyncLimit
+    ##  requests run at once in the whole process.
+    ##
+    ##  Python API, cdq.py imports it as well:
+    ##
+    ##      async for record in cdq.fetch_cdx({'url': 'example.org'}):
+    ##          print(record['original'])
+clientName = 'cdx-tools'     # str. User-Agent of every request, replaced by clientSetup()
+asyncLimit = 50              # int. global cap on concurrent requests
+asyncState = {'loop': None}  # dict. semaphore and connection pool of the running loop
+
+
+def clientSetup(name, limit=50):
+
+    # name goes in the User-Agent header of every request, limit caps the
+    # requests the asyncio engine has in flight at once.
+
+    global clientName, asyncLimit
+    clientName = name
+    asyncLimit = limit
+
+
+def requestHeaders():
+    return {"User-Agent": clientName, "Accept-Encoding": "gzip"}
+
+
+def asyncSetup():
+
+    # The semaphore and the pooled streams belong to one event loop,
+    # start over whenever a new loop is running.
+
+    loop = asyncio.get_running_loop()
+    if asyncState['loop'] is not loop:
+        asyncState['loop']      = loop
+        asyncState['semaphore'] = asyncio.Semaphore(asyncLimit)
+        asyncState['pool']      = {}
+    return asyncState
+
+
+async def closeAsyncPool():
+    for connections in asyncSetup()['pool'].values():
+        for reader, writer in connections:
+            writer.close()
+        del connections[:]
+
+
+async def asyncHTTPGet(url, timeout):
+
+    # Async generator: GET url over HTTP/1.1 and yield the body in chunks.
+    # Connections are kept alive and reused for the same scheme/host/port.
+
+    parts  = urllib.parse.urlsplit(url)
+    port   = parts.port or (443 if parts.scheme == "https" else 80)
+    target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+    pool   = asyncSetup()['pool'].setdefault((parts.scheme, parts.hostname, port), [])
+
+    request = (
+                "GET " + target + " HTTP/1.1\r\n"
+                + "Host: " + parts.netloc + "\r\n"
+                + "User-Agent: " + requestHeaders()["User-Agent"] + "\r\n"
+                + "Accept-Encoding: gzip\r\n"
+                + "Connection: keep-alive\r\n\r\n"
+    ).encode('latin-1')
+
+    for attempt in range(2):
+        reused = len(pool) > 0 and attempt == 0  # the retry always opens a new connection
+        if reused == True:
+            reader, writer = pool.pop()
+        else:
+            sslContext = ssl.create_default_context() if parts.scheme == "https" else None
+            reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(parts.hostname, port, ssl=sslContext),
+                    timeout
+            )
+        try:
+            writer.write(request)
+            await writer.drain()
+            statusLine = await asyncio.wait_for(reader.readline(), timeout)
+        except OSError:
+            writer.close()
+            if reused == True:  # the server dropped an idle connection
+                continue
+            raise
+        if statusLine == b"" and reused == True:
+            writer.close()
+            continue
+        break
+
+    if statusLine == b"":
+        writer.close()
+        raise ConnectionError("Connection closed without a response by " + parts.netloc)
+
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, colon, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    reusable = headers.get('connection', '').lower() != "close"
+    complete = False
+    try:
+        status = statusLine.split()
+        if len(status) < 2 or status[1] != b"200":
+            raise ConnectionError(
+                    "HTTP status " + statusLine.decode('latin-1').strip() + " for " + url
+            )
+
+        if "chunked" in headers.get('transfer-encoding', '').lower():
+            while True:
+                size = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size.split(b";")[0].strip(), 16)
+                if size == 0:
+                    while await asyncio.wait_for(reader.readline(), timeout) not in (b"\r\n", b"\n", b""):
+                        pass  # skip trailers
+                    break
+                yield await asyncio.wait_for(reader.readexactly(size), timeout)
+                await asyncio.wait_for(reader.readexactly(2), timeout)  # CRLF
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(chunkSize, remaining)), timeout)
+                if chunk == b"":
+                    raise ConnectionError("Connection closed early by " + parts.netloc)
+                remaining -= len(chunk)
+                yield chunk
+        else:  # body ends when the server closes the connection
+            reusable = False
+            while True:
+                chunk = await asyncio.wait_for(reader.read(chunkSize), timeout)
+                if chunk == b"":
+                    break
+                yield chunk
+        complete = True
+    finally:
+        if complete == True and reusable == True:
+            pool.append((reader, writer))
+        else:
+            writer.close()
+
+
+async def asyncGunzipChunks(chunks):
+    state = {}
+    async for chunk in chunks:
+        progressAdd(received=len(chunk))
+        data = gunzip(state, chunk)
+        if data:
+            yield data
+    data = gunzip(state, None)
+    if data:
+        yield data
+
+
+async def asyncFileChunks(path):
+    with gzip.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            yield chunk
+
+
+async def fetch_cdx(query, timeout=60):
+
+    # Async iterator of CDX records (one dictionary per row).
+    # query is a fully built CDX URL, or a dictionary of CDX parameters
+    # where a list value becomes a repeated parameter (several filters).
+    # output=text is parsed line by line, anything else as JSON.
+    # Raises ConnectionError if the server doesn't answer with HTTP 200.
+
+    if isinstance(query, dict):
+        params = dict(query)
+        if params.get('output') != 'text':
+            params['output'] = 'json'
+        url = "https://web.archive.org/cdx/search/cdx?" + urllib.parse.urlencode(params, doseq=True)
+    else:
+        url = query
+
+    chunks = asyncBody(url, timeout)
+
+    keys = textKeys(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query)))
+    if keys != None:
+        state = {}
+        async for chunk in chunks:
+            for record in textRecords(textLines(state, chunk), keys):
+                yield record
+        for record in textRecords(textLines(state, None), keys):
+            yield record
+        return
+
+    rows   = ijson.sendable_list()
+    parser = ijson.items_coro(rows, 'item', use_float=True)
+    keys   = None  # first row holds the JSON keys
+    final  = False
+    while final == False:
+        try:
+            parser.send(await chunks.__anext__())
+        except StopAsyncIteration:
+            parser.close()
+            final = True
+        for row in rows:
+            if keys == None:
+                keys = row
+            else:
+                yield dict(zip(keys, row))
+        del rows[:]
+
+
+async def asyncBody(url, timeout=60):
+
+    # Async iterator of the decompressed response body of url, from the
+    # cache if possible. Counts against asyncLimit until it is exhausted.
+
+    async with asyncSetup()['semaphore']:
+        cached = cacheGet(url)
+        if cached != None:
+            chunks = statsAsyncIter('cache', asyncFileChunks(cached))
+        else:
+            statsCount('requests')
+            chunks = statsAsyncIter('network', asyncHTTPGet(url, timeout), 'bytes_received')
+            chunks = asyncCacheChunks(asyncGunzipChunks(chunks), url)
+        async for chunk in chunks:
+            yield chunk
+
+
+ ########################################
+  ####  STRING MATCHING
+   ###  The search strings and negative keywords of cdf.py and cdxpress.py
+    ##  are compiled into an Aho-Corasick automaton, so every string can be
+    ##  found in a single pass over a URL. Up to matcherLoopMax strings are
+    ##  cheaper to find with 'in' one after the other (C string search) than
+    ##  with the automaton walked in Python character by character, then no
+    ##  automaton is built.
+matcherLoopMax = 32  # int. most search strings matched with 'in' instead of the automaton
+
+
+def buildMatcher(patterns):
+
+    # Each pattern is reported by its index in the list; duplicates are
+    # kept so every occurrence is counted just like the old nested loop.
+
+    if len(patterns) <= matcherLoopMax:
+        return {
+                'goto':     None,
+                'patterns': list(patterns),
+        }
+
+    goto   = [{}]  # list of dicts. character transitions per node
+    fail   = [0]   # list of ints.  failure link per node
+    out    = [[]]  # list of lists. pattern indexes ending at each node
+    always = []    # list. empty patterns, these match every string
+
+    for index, pattern in enumerate(patterns):
+        if pattern == "":
+            always.append(index)
+            continue
+        node = 0
+        for char in pattern:
+            nextNode = goto[node].get(char)
+            if nextNode == None:
+                nextNode = len(goto)
+                goto[node][char] = nextNode
+                goto.append({})
+                fail.append(0)
+                out.append([])
+            node = nextNode
+        out[node].append(index)
+
+    # breadth-first walk to set failure links, children of root fail to root
+    queue = collections.deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for char, nextNode in goto[node].items():
+            queue.append(nextNode)
+            state = fail[node]
+            while state != 0 and char not in goto[state]:
+                state = fail[state]
+            fail[nextNode] = goto[state].get(char, 0)
+            out[nextNode] = out[nextNode] + out[fail[nextNode]]
+
+    return {
+            'goto':     goto,
+            'fail':     fail,
+            'out':      out,
+            'always':   always,
+            'patterns': list(patterns),  # for --stats
+    }
+
+
+def findMatches(matcher, text, first=False):
+
+    # Returns a sorted list of pattern indexes found in text.
+    # With first=True, stop at the first hit (used for negative keywords).
+
+    goto = matcher['goto']
+    if goto == None:  # a few strings, see buildMatcher()
+        if first == True:
+            for index, pattern in enumerate(matcher['patterns']):
+                if pattern in text:
+                    return [index]
+            return []
+        return [index for index, pattern in enumerate(matcher['patterns']) if pattern in text]
+
+    fail = matcher['fail']
+    out  = matcher['out']
+
+    hits = set(matcher['always'])
+    if first == True and hits:
+        return sorted(hits)
+
+    node = 0
+    for char in text:
+        while node != 0 and char not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(char, 0)
+        if out[node]:
+            hits.update(out[node])
+            if first == True:
+                break
+
+    return sorted(hits)
+
+
+
+ ########################################
+  ####  STATS
+   ###  --stats splits the run time into phases. The clock of each thread
+    ##  is always charged to one phase, statsEnter() switches to another
+    ##  and returns the one it left. Wrapped iterators charge the time
+    ##  spent producing each item to their phase and switch back, so nested
+    ##  generators are not counted twice. Worker threads are reported as
+    ##  "phase (threads)", their sum can exceed the wall time. Import time
+    ##  is what elapsed between the tool's startTime and statsStart().
+statsOn       = False               # bool. --stats, replaced by statsEnable()
+statsFormat   = None                # str.  'text' or 'json'
+statsStarted  = time.time()         # float. startTime of the tool
+statsOrder    = ()                  # tuple. phases of the tool in report order
+statsPhases   = {}                  # dict. phase -> seconds
+statsCounters = {}                  # dict. counter -> int, or key -> int
+statsClock    = threading.local()   # running phase of each thread, since when
+statsLock     = threading.Lock()    # guards statsPhases and statsCounters
+
+
+def statsStart(started, order):
+    global statsStarted, statsOrder
+    statsStarted          = started
+    statsOrder            = order
+    statsPhases['import'] = time.time() - started
+    statsClock.phase      = 'setup'
+    statsClock.mark       = time.perf_counter()
+
+
+def statsEnable(format):
+
+    # format is the value of --stats: 'text', 'json' or None when off.
+
+    global statsOn, statsFormat
+    statsFormat = format
+    statsOn     = format != None
+
+
+def statsEnter(phase):
+    if statsOn == False:
+        return None
+    now      = time.perf_counter()
+    previous = getattr(statsClock, 'phase', None)  # None in a new thread
+    if previous != None:
+        name = previous
+        if threading.current_thread() is not threading.main_thread():
+            name = previous + " (threads)"
+        with statsLock:
+            statsPhases[name] = statsPhases.get(name, 0.0) + now - statsClock.mark
+    statsClock.phase = phase
+    statsClock.mark  = now
+    return previous
+
+
+def statsCount(counter, amount=1, key=None):
+    if statsOn == False:
+        return
+    with statsLock:
+        if key == None:
+            statsCounters[counter] = statsCounters.get(counter, 0) + amount
+        else:
+            keys = statsCounters.setdefault(counter, {})
+            keys[key] = keys.get(key, 0) + amount
+
+
+def statsIter(phase, items, counter=None):
+
+    # items, with the time spent producing them charged to phase. counter
+    # counts the items, or their bytes for 'bytes_received'.
+
+    if statsOn == False:
+        return items
+    return statsTimed(phase, iter(items), counter)
+
+
+def statsTimed(phase, items, counter):
+    while True:
+        previous = statsEnter(phase)
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            statsEnter(previous)
+        if counter == 'bytes_received':
+            statsCount(counter, len(item))
+        elif counter != None:
+            statsCount(counter)
+        yield item
+
+
+def statsAsyncIter(phase, items, counter=None):
+    if statsOn == False:
+        return items
+    return statsAsyncTimed(phase, items, counter)
+
+
+async def statsAsyncTimed(phase, items, counter):
+    while True:
+        previous = statsEnter(phase)
+        try:
+            item = await items.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            statsEnter(previous)
+        if counter == 'bytes_received':
+            statsCount(counter, len(item))
+        elif counter != None:
+            statsCount(counter)
+        yield item
+
+
+def printStats(tool, version):
+
+    # Report of --stats on stderr, tool and version name the program.
+
+    if statsOn == False:
+        return
+    statsEnter('other')  # close the running phase
+
+    phases = [phase for phase in statsOrder if phase in statsPhases]
+    phases = phases + [phase for phase in statsPhases if phase not in statsOrder]
+    report = {
+                'tool':     tool,
+                'version':  version,
+                'seconds':  round(time.time() - statsStarted, 4),
+                'phases':   {phase: round(statsPhases[phase], 4) for phase in phases},
+                'counters': statsCounters,
+    }
+
+    if statsFormat == 'json':
+        print(json.dumps(report, indent=4), file=sys.stderr)
+        return
+
+    lines = ["\nStats:"]
+    for phase in phases:
+        lines.append("  " + phase.ljust(20) + ("%.3f" % statsPhases[phase]).rjust(12) + " s")
+    lines.append("  " + "total".ljust(20) + ("%.3f" % report['seconds']).rjust(12) + " s")
+    for counter, value in statsCounters.items():
+        if isinstance(value, dict):
+            lines.append("  " + counter + ":")
+            for key in value:
+                lines.append("    " + str(key).ljust(18) + str(value[key]).rjust(12))
+        else:
+            lines.append("  " + counter.ljust(20) + str(value).rjust(12))
+    print("\n".join(lines), file=sys.stderr)
@@ -4,6 +4,9 @@
 import time
 startTime = time.time()
 import argparse
+import asyncio
+import cdxcommon
+import gzip
 import ijson
 import json
 import os
@@ -11,16 +14,32 @@ import os.path
 import random
 import re
 import requests
+import signal
 import sys
 import textwrap
 import urllib.parse
-
+import zlib
+
+from cdxcommon import chunkSize, cacheSetup, cacheGet, cacheChunks
+from cdxcommon import statsStart, statsEnable, statsEnter, statsCount
+from cdxcommon import statsIter, statsAsyncIter, printStats
+from cdxcommon import buildMatcher, findMatches
+from cdxcommon import progressStart, progressStop, progressPrint
+from cdxcommon import textKeys, textLines, textRecords, gunzipChunks, rawChunks
+from cdxcommon import clientSetup, requestHeaders, closeAsyncPool, fetch_cdx
 from pathlib import Path
 from requests.utils import quote
 
 
 version = '0.2b'
 
+sinkBuffer = 1024 * 1024  # int. output buffer size in bytes for each sink
+statsOrder = (            # tuple. --stats phases in report order
+                    'import', 'setup', 'network', 'cache', 'parse', 'match',
+                    'write', 'other'
+)
+
+
 #-------------------------------------#
 #          cdxpress  by av1d          #
 #-------------------------------------#
@@ -140,6 +159,87 @@ def setArgs():
                 +  "Omit --to and --from for all dates.\n"
                 + sep(),
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        required=False,
+        help=
+                "Don't read or write the local response cache.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        required=False,
+        help=
+                "Always query the server, then update the cache.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        metavar='SECONDS',
+        type=int,
+        default=86400,
+        required=False,
+        help=
+                "Cached responses older than this are fetched again.\n"
+                + "Default: 86400 (1 day).\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB',
+        type=int,
+        default=1024,
+        required=False,
+        help=
+                "Maximum size of the cache in megabytes. The least\n"
+                + "recently used responses are removed first.\n"
+                + "Default: 1024.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIRECTORY',
+        required=False,
+        help=
+                "Cache directory, shared by cdx-query and cdxpress.\n"
+                + "Default: ~/.cache/cdx-tools\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--text',
+        action='store_true',
+        required=False,
+        help=
+                "Ask the server for the plain text CDX format instead\n"
+                + "of JSON, it is parsed line by line.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['requests', 'asyncio'],
+        default='requests',
+        required=False,
+        help=
+                "HTTP engine: 'requests' or 'asyncio', a small client\n"
+                + "on asyncio streams. Default: requests.\n"
+                + sep(),
+    )
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=['text', 'json'],
+        required=False,
+        help=
+                "When done, print to stderr how long each phase took\n"
+                + "(import, setup, network, parse, match, write) and\n"
+                + "counters: records, bytes received, matches per search\n"
+                + "string, exclusions and bytes written.\n"
+                + "--stats json prints them as JSON.\n"
+                + sep(),
+    )
     parser.add_argument(
         '-v',
         '--version',
@@ -153,6 +253,21 @@ def setArgs():
     global args  # dict
     args = vars(parser.parse_args())
 
+    statsEnable(args['stats'])  # print --stats when done
+    clientSetup("cdxpress/" + version)
+
+    cacheMode = 'use'  # str. 'use', 'refresh' or 'off'
+    if args['refresh_cache'] == True:
+        cacheMode = 'refresh'
+    if args['no_cache'] == True:
+        cacheMode = 'off'
+    cacheSetup(
+                cacheMode,
+                args['cache_ttl'],
+                args['cache_size'] * 1024 * 1024,
+                args['cache_dir']
+    )
+
 
     if args['to'] != None and args['from'] != None:
         if int(args['to']) - int(args['from']) < 0:
@@ -203,6 +318,42 @@ def setArgs():
 
 
 
+def openSinks():
+
+    # Open the output file once. Writes go through a large buffer and are
+    # flushed when the sinks are closed or on a signal.
+
+    global sinks  # dict. open file objects keyed by target name
+    sinks = {}
+
+    if args['outfile'] != None:
+        sinks['list'] = open(args['outfile'], 'a', buffering=sinkBuffer)
+
+    signal.signal(signal.SIGINT, sinkSignal)
+    signal.signal(signal.SIGTERM, sinkSignal)
+
+
+
+def writeSink(name, data):
+    sinks[name].write(data)
+    if cdxcommon.statsOn == True:
+        statsCount('output_bytes', len(data.encode('utf-8')), name)
+
+
+
+def closeSinks():
+    for name in list(sinks.keys()):
+        sinks.pop(name).close()  # close() flushes the buffer
+
+
+
+def sinkSignal(signum, frame):
+    closeSinks()
+    print("\nInterrupted. Output written so far has been saved.")
+    sys.exit(1)
+
+
+
 def generateOutput(url_string, timestamp):
 
     wayback = "https://web.archive.org/web/"
@@ -213,10 +364,20 @@ def generateOutput(url_string, timestamp):
                 str(url_string)
     )
 
+    previous = statsEnter('write')
     if args['outfile'] != None:
-        with open(args['outfile'], 'a') as f:
-            f.write(outURL + "\n")
-    print(outURL)
+        writeSink('list', outURL + "\n")
+    progressPrint(outURL)
+    if cdxcommon.statsOn == True:
+        statsCount('output_bytes', len(outURL.encode('utf-8')) + 1, 'stdout')
+    statsEnter(previous)
+
+
+
+def fileChunks(f):
+    with f:
+        for chunk in iter(lambda: f.read(chunkSize), b""):
+            yield chunk
 
 
 
@@ -225,16 +386,28 @@ def fetchResponse(URL):
     timeoutSEC = 60  # http timeout in seconds
 
     print("\nFetching: " + URL)
-    print("Response timeout set to: " + str(timeoutSEC) + " seconds")
 
-    clientVersion = "cdxpress/" + version
-    headers = {"User-Agent": clientVersion}
+    keys = textKeys(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(URL).query)))
+    if keys != None:
+        records = lambda chunks: cdxTextRecords(chunks, keys)
+    else:
+        records = cdxRecords
+
+    cached = cacheGet(URL)
+    if cached != None:
+        print("Using cached response: " + cached + "\n")
+        chunks = statsIter('cache', fileChunks(gzip.open(cached, 'rb')))
+        return statsIter('parse', records(chunks), 'records')
+
+    print("Response timeout set to: " + str(timeoutSEC) + " seconds")
 
     #Download the response
+    previous = statsEnter('network')
+    statsCount('requests')
     try:
         response = requests.get(
                                     URL,
-                                    headers=headers,
+                                    headers=requestHeaders(),
                                     timeout=timeoutSEC,
                                     stream=True
         )
@@ -243,6 +416,7 @@ def fetchResponse(URL):
         raise SystemExit("Connection timed out")
     except requests.exceptions.RequestException as e:
         raise SystemExit(e)
+    statsEnter(previous)
 
     if str(response.status_code) == "200":
         print("Received HTTP status: ", response.status_code, response.reason, " - connected to server.")
@@ -255,62 +429,109 @@ def fetchResponse(URL):
 
     print("\nDownloading the response may take a long time, do not stop the program...\n")
 
-    n = json.loads(response.text)  # parse API response
-    
-    keys = []  # holds JSON keys
+    chunks = statsIter('network', rawChunks(response), 'bytes_received')
+    chunks = gunzipChunks(chunks)  # decompressed on the fly
+    return statsIter('parse', records(cacheChunks(chunks, URL)), 'records')
+
+
+
+def cdxRecords(chunks):
+
+    # Generator: feed the response to an incremental parser chunk by chunk
+    # and yield one dictionary per row straight to the matcher, nothing
+    # is re-serialized.
+
+    rows   = ijson.sendable_list()
+    parser = ijson.items_coro(rows, 'item', use_float=True)
+    keys   = None  # first row holds the JSON keys
+
+    try:
+        for chunk in chunks:
+            parser.send(chunk)
+            for row in rows:
+                if keys == None:
+                    keys = row
+                else:
+                    yield dict(zip(keys, row))
+            del rows[:]
+        parser.close()
+    except ijson.JSONError:
+        print("\n--- Error: An unknown error has occurred. The response is not valid JSON.\n")
+        sys.exit(1)
 
-    if not n:  # if list is empty...
+    if not keys:  # if list is empty...
         print("\n--- Error: Response file is empty. Likely the URL provided is invalid or is not archived.")
         sys.exit(1)
 
-    for i in n[0]:
-        try:
-            keys.append(i)  # add the keys to the list
-        except:
-            print("\n--- Error: An unknown error has occurred. The response is missing the appropriate keys.\n")
-            sys.exit(1)
 
-    x = [dict(zip(keys, l)) for l in n]  # create list of dictionaries
-    x.pop(0)  # remove first line containing JSON keys
-    
-    final_out = '[\n' + ',\n'.join(json.dumps(i) for i in x) + '\n]'  # format list
-    final_out = json.loads(final_out)
-    return(final_out)
 
+def cdxTextRecords(chunks, keys):
 
+    # Generator: same as cdxRecords() for the text format, each line is
+    # split into the columns as soon as it has arrived.
 
-def checkMatch(url_string, timestamp):
+    state = {}
+    for chunk in chunks:
+        yield from textRecords(textLines(state, chunk), keys)
+    yield from textRecords(textLines(state, None), keys)
 
-    global scanLINES  # int.  counter for --scan
-    global textLINES  # int.  counter for --textfile
-    global neg_match  # bool. track if a negative keyword was found
 
-    originalString = url_string
 
-    for key in options.keys():
-        currentKey = options[key]
-        for string in currentKey:
+##  ASYNCIO ENGINE
+##  --engine asyncio reads the records from fetch_cdx(query) of the
+##  client in cdxcommon.py, shared with cdx-query.
+
+
+
+async def asyncScan(URL):
+    try:
+        async for line in statsAsyncIter('parse', fetch_cdx(URL), 'records'):
+            checkMatch(line['original'], line['timestamp'])
+    finally:
+        await closeAsyncPool()
+
+
+
+def compileMatcher():
+
+    # Build the automatons once from options and neg_words before scanning.
+
+    global matcher     # dict. automaton for search strings
+    global negMatcher  # dict. automaton for negative keywords
 
+    patterns = []
+    for key in options.keys():
+        for string in options[key]:
             if args['case_sensitive'] == False:
-                string        = string.lower()
-                url_string    = url_string.lower()
+                string = string.lower()
+            patterns.append(string)
+
+    matcher    = buildMatcher(patterns)
+    negMatcher = buildMatcher(neg_words)
 
-            if neg_words:  # if negative keywords were specified
-                checkNegMatch(url_string)
 
-            if neg_match == False:  # if no match on neg word, continue
-                if string in url_string:
-                    scanLINES += 1
-                    generateOutput(originalString, timestamp)
-    neg_match = False
 
+def checkMatch(url_string, timestamp):
+
+    global scanLINES  # int.  counter for --scan
+
+    originalString = url_string
 
+    if args['case_sensitive'] == False:
+        url_string = url_string.lower()
 
-def checkNegMatch(url_string):  # check for negative keywords, if specified
-    global neg_match  # bool. track if a negative keyword was found
-    for word in neg_words:
-        if word in url_string:
-            neg_match = True
+    if neg_words:  # if negative keywords were specified
+        excluded = findMatches(negMatcher, url_string, first=True)
+        if excluded:
+            if cdxcommon.statsOn == True:
+                statsCount('excluded', 1, negMatcher['patterns'][excluded[0]])
+            return
+
+    for index in findMatches(matcher, url_string):
+        scanLINES += 1
+        if cdxcommon.statsOn == True:
+            statsCount('matches', 1, matcher['patterns'][index])
+        generateOutput(originalString, timestamp)
 
 
 
@@ -320,6 +541,7 @@ def main():
         print("cdxpress v" + version)
         sys.exit(0)
 
+    statsStart(startTime, statsOrder)
 
     setArgs()
 
@@ -352,8 +574,10 @@ def main():
           + theHost
           + thePath
           + matchType
-          + "&collapse=urlkey&output=json&gzip=false&filter=statuscode:200&fl=timestamp,original"
+          + "&collapse=urlkey&output=json&filter=statuscode:200&fl=timestamp,original"
     )
+    if args['text'] == True:
+        cdxURL = cdxURL.replace("&output=json", "&output=text")
 
     if args['to'] != None:
         userToDate = "&to=" + str(args['to'])
@@ -362,18 +586,24 @@ def main():
         userFromDate = "&from=" + str(args['from'])
         cdxURL = cdxURL + userFromDate
 
-    data = fetchResponse(cdxURL)  # JSON containing lists of dictionaries from API response
+    statsEnter('other')
+
+    if args['engine'] == 'asyncio':
+        print("\nFetching: " + cdxURL)
+        data = None  # records are pulled by asyncScan()
+    else:
+        data = fetchResponse(cdxURL)  # generator, one dictionary per CDX row
 
 
     global scanLINES  #int.  counts found items
     scanLINES = 0
     global neg_words  #list. contains negative search words
     neg_words = []
-    global neg_match  #bool. track if a negative keyword was found
-    neg_match = False
     global options    #dict. comtains search queries
     options = {}
 
+    openSinks()
+
     ##  --exclude negative keywords.  build list of negative search keywords
     if args['exclude'] != None:
         neg_words = args['exclude'].split(',')  # split input string into list
@@ -384,15 +614,32 @@ def main():
         scanType = 'scan'
         scanList = args['scan'].split(',')  # split input string into list
         options['scan'] = scanList          # add the list to the dict to scan
-        count = 0
-        for line in data:
-            fileURL       = data[count]['original']
-            fileTimestamp = data[count]['timestamp']
-            checkMatch(fileURL, fileTimestamp)
-            count += 1
+        compileMatcher()
+        statsEnter('match')
+        progressStart()
+        if data == None:
+            try:
+                asyncio.run(asyncScan(cdxURL))
+            except (OSError, asyncio.TimeoutError, zlib.error) as e:
+                progressStop()
+                closeSinks()
+                raise SystemExit(str(e) or type(e).__name__)
+        else:
+            try:
+                for line in data:
+                    fileURL       = line['original']
+                    fileTimestamp = line['timestamp']
+                    checkMatch(fileURL, fileTimestamp)
+            except (requests.exceptions.RequestException, zlib.error) as e:
+                progressStop()
+                closeSinks()
+                raise SystemExit(str(e) or type(e).__name__)
+        statsEnter('other')
 
 
     ##  RESULTS
+    progressStop()
+    closeSinks()
     print("\nScan complete.")
 
     if args['case_sensitive'] == True:
@@ -416,6 +663,8 @@ def main():
             " seconds"
     )
 
+    printStats('cdxpress', version)
+
 
 
 if __name__ == '__main__':